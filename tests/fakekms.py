@@ -0,0 +1,493 @@
+#!/usr/bin/python3
+
+"""Virtual KMS device implementing the subset of the pykms API used by the
+tests. It is selected by kmstest.py when the KMSTEST_BACKEND environment
+variable is set to "fake", and allows running the tests and benchmarking the
+harness without display hardware."""
+
+import errno
+import math
+import mmap
+import os
+import threading
+import time
+import weakref
+
+
+class DrmEventType(object):
+    VBLANK = 1
+    FLIP_COMPLETE = 2
+
+
+class PixelFormat(object):
+    XRGB8888 = "XR24"
+    ARGB8888 = "AR24"
+    XBGR8888 = "XB24"
+    ABGR8888 = "AB24"
+    RGB888 = "RG24"
+    RGB565 = "RG16"
+
+
+# Bytes per pixel for the supported formats
+FORMAT_CPP = {
+    PixelFormat.XRGB8888: 4,
+    PixelFormat.ARGB8888: 4,
+    PixelFormat.XBGR8888: 4,
+    PixelFormat.ABGR8888: 4,
+    PixelFormat.RGB888: 3,
+    PixelFormat.RGB565: 2,
+}
+
+
+class Videomode(object):
+    """A display mode, with the timings of the DRM mode structure."""
+
+    def __init__(self, name, clock, hdisplay, hsync_start, hsync_end, htotal,
+                 vdisplay, vsync_start, vsync_end, vtotal, flags=0, type=0):
+        self.name = name
+        self.clock = clock
+        self.hdisplay = hdisplay
+        self.hsync_start = hsync_start
+        self.hsync_end = hsync_end
+        self.htotal = htotal
+        self.hskew = 0
+        self.vdisplay = vdisplay
+        self.vsync_start = vsync_start
+        self.vsync_end = vsync_end
+        self.vtotal = vtotal
+        self.vscan = 0
+        self.vrefresh = round(clock * 1000 / (htotal * vtotal))
+        self.flags = flags
+        self.type = type
+
+    def to_blob(self, card):
+        return Blob(card, self)
+
+
+class DrmObject(object):
+    """Base class for all DRM objects, with an ID and a set of properties."""
+
+    PROPERTIES = ()
+
+    def __init__(self, card):
+        self.card = card
+        self.id = card._allocate_id(self)
+        self.props = {name: 0 for name in self.PROPERTIES}
+        # Objects referenced by the committed properties, kept alive as long
+        # as they are in use by the device
+        self.refs = {}
+
+    def __repr__(self):
+        return "<%s %u>" % (self.__class__.__name__, self.id)
+
+
+class Blob(DrmObject):
+    def __init__(self, card, data):
+        super().__init__(card)
+        self.data = data
+
+
+class Connector(DrmObject):
+    PROPERTIES = ('CRTC_ID',)
+
+    def __init__(self, card, fullname, crtcs, modes):
+        super().__init__(card)
+        self.fullname = fullname
+        self.__crtcs = crtcs
+        self.__modes = modes
+
+    def connected(self):
+        return len(self.__modes) != 0
+
+    def get_modes(self):
+        return list(self.__modes)
+
+    def get_default_mode(self):
+        if not self.__modes:
+            raise ValueError("no modes available")
+        return self.__modes[0]
+
+    def get_possible_crtcs(self):
+        return list(self.__crtcs)
+
+    def get_current_crtc(self):
+        return self.card._object(self.props['CRTC_ID'], Crtc)
+
+
+class Crtc(DrmObject):
+    PROPERTIES = ('ACTIVE', 'MODE_ID')
+
+    def __init__(self, card, index):
+        super().__init__(card)
+        self.index = index
+        self.primary_plane = None
+
+        # Timestamp of the first vblank and vblank period
+        self.vblank_start = 0
+        self.vblank_period = 0
+
+    def next_vblank(self, now):
+        """Return the sequence number and time of the first vblank after now."""
+        seq = math.floor((now - self.vblank_start) / self.vblank_period) + 1
+        return seq, self.vblank_start + seq * self.vblank_period
+
+
+class Plane(DrmObject):
+    PROPERTIES = ('FB_ID', 'CRTC_ID', 'SRC_X', 'SRC_Y', 'SRC_W', 'SRC_H',
+                  'CRTC_X', 'CRTC_Y', 'CRTC_W', 'CRTC_H')
+
+    def __init__(self, card, crtcs):
+        super().__init__(card)
+        self.__crtcs = crtcs
+
+    def supports_crtc(self, crtc):
+        return crtc in self.__crtcs
+
+
+class DumbFramebuffer(DrmObject):
+    """A framebuffer backed by anonymous memory."""
+
+    def __init__(self, card, width, height, format):
+        super().__init__(card)
+        if format not in FORMAT_CPP:
+            raise ValueError("unsupported format %s" % format)
+
+        self.width = width
+        self.height = height
+        self.format = format
+        self.num_planes = 1
+        self.__stride = width * FORMAT_CPP[format]
+        self.__buffer = mmap.mmap(-1, self.__stride * height)
+
+    def stride(self, plane):
+        return self.__stride
+
+    def size(self, plane):
+        return self.__stride * self.height
+
+    def offset(self, plane):
+        return 0
+
+    def map(self, plane):
+        return memoryview(self.__buffer)
+
+
+class Event(object):
+    def __init__(self, type, seq, time, data, crtc_id):
+        self.type = type
+        self.seq = seq
+        self.time = time
+        self.data = data
+        self.crtc_id = crtc_id
+
+
+class Card(object):
+    """A virtual KMS device. The device has one connector per CRTC, with a
+    primary and an overlay plane for each CRTC. Page flip events are
+    delivered at the refresh rate of the mode through an eventfd, signalled
+    by a vblank thread."""
+
+    # Connector names and mode lists. A connector without modes is reported
+    # as disconnected.
+    CONNECTORS = (
+        ('HDMI-A-1', (
+            Videomode("1920x1080", 148500, 1920, 2008, 2052, 2200, 1080, 1084, 1089, 1125),
+            Videomode("1280x720", 74250, 1280, 1390, 1430, 1650, 720, 725, 730, 750),
+            Videomode("1920x1080", 297000, 1920, 2008, 2052, 2200, 1080, 1084, 1089, 1125),
+            Videomode("1920x1080", 594000, 1920, 2008, 2052, 2200, 1080, 1084, 1089, 1125),
+            Videomode("640x480", 25175, 640, 656, 752, 800, 480, 490, 492, 525),
+        )),
+        ('LVDS-1', (
+            Videomode("1280x800", 71000, 1280, 1328, 1360, 1440, 800, 803, 809, 823),
+        )),
+        ('VGA-1', ()),
+    )
+
+    def __init__(self):
+        # Blobs and framebuffers are destroyed when the last reference to them
+        # is dropped. The committed state of the objects holds references to
+        # the blobs and framebuffers it uses.
+        self.__objects = weakref.WeakValueDictionary()
+        self.__next_id = 1
+
+        self.crtcs = [Crtc(self, i) for i in range(len(self.CONNECTORS))]
+        self.connectors = [Connector(self, name, self.crtcs, modes)
+                           for name, modes in self.CONNECTORS]
+        self.planes = []
+        for crtc in self.crtcs:
+            crtc.primary_plane = Plane(self, [crtc])
+            self.planes.append(crtc.primary_plane)
+            self.planes.append(Plane(self, [crtc]))
+
+        self.has_atomic = True
+
+        # Page flip events are queued in the pending list as (time, crtc, data,
+        # sequence) tuples by the atomic commits, and moved to the completed list by the
+        # vblank thread.
+        self.fd = os.eventfd(0, os.EFD_CLOEXEC)
+        self.__lock = threading.Condition()
+        self.__pending = []
+        self.__completed = []
+        self.__thread = threading.Thread(target=self.__vblank_thread, daemon=True)
+        self.__thread.start()
+
+    def _allocate_id(self, obj):
+        id = self.__next_id
+        self.__next_id += 1
+        self.__objects[id] = obj
+        return id
+
+    def _object(self, id, cls):
+        obj = self.__objects.get(id)
+        return obj if isinstance(obj, cls) else None
+
+    def _flip_pending(self, crtc):
+        with self.__lock:
+            return any(event[1] == crtc for event in self.__pending + self.__completed)
+
+    def _queue_flip(self, crtc, data):
+        """Queue a page flip event for the next vblank of the CRTC."""
+        seq, when = crtc.next_vblank(time.clock_gettime(time.CLOCK_MONOTONIC))
+        with self.__lock:
+            self.__pending.append((when, crtc, data, seq))
+            self.__pending.sort(key=lambda event: event[0])
+            self.__lock.notify()
+
+    def __vblank_thread(self):
+        with self.__lock:
+            while True:
+                if not self.__pending:
+                    self.__lock.wait()
+                    continue
+
+                timeout = self.__pending[0][0] - time.clock_gettime(time.CLOCK_MONOTONIC)
+                if timeout > 0:
+                    self.__lock.wait(timeout)
+                    continue
+
+                self.__completed.append(self.__pending.pop(0))
+                os.eventfd_write(self.fd, 1)
+
+    def signal_flip(self, crtc, data=0):
+        """Emit a page flip event for the CRTC immediately, without an atomic
+        commit. This allows measuring the event dispatch overhead
+        independently of the vblank timing."""
+        now = time.clock_gettime(time.CLOCK_MONOTONIC)
+        with self.__lock:
+            self.__completed.append((now, crtc, data, 0))
+        os.eventfd_write(self.fd, 1)
+
+    def read_events(self):
+        # Raises BlockingIOError in non-blocking mode when no event is pending,
+        # as the DRM device does.
+        os.eventfd_read(self.fd)
+
+        with self.__lock:
+            completed = self.__completed
+            self.__completed = []
+
+        for when, crtc, data, seq in completed:
+            yield Event(DrmEventType.FLIP_COMPLETE, seq, when, data, crtc.id)
+
+
+class AtomicReq(object):
+    """An atomic request. Commits are checked against a simplified version of
+    the DRM core constraints."""
+
+    # Properties that reference other objects, with the object class
+    REFERENCES = {
+        'CRTC_ID': Crtc,
+        'FB_ID': DumbFramebuffer,
+        'MODE_ID': Blob,
+    }
+
+    def __init__(self, card):
+        self.card = card
+        self.props = {}
+
+    def add(self, obj, prop, value=None):
+        if isinstance(prop, dict):
+            for name, value in prop.items():
+                self.add(obj, name, value)
+            return
+
+        if prop not in obj.props:
+            raise RuntimeError("Property %s not found on object %u" % (prop, obj.id))
+
+        self.props.setdefault(obj, {})[prop] = value
+
+    def __signed(self, value):
+        # Properties are passed as unsigned 64-bit integers, the CRTC
+        # coordinates are signed 32-bit integers.
+        value &= (1 << 32) - 1
+        return value - (1 << 32) if value & (1 << 31) else value
+
+    def __check(self, allow_modeset):
+        """Check the request and return the new state of the objects it
+        affects, or a negative error code."""
+        state = {obj: dict(obj.props, **props) for obj, props in self.props.items()}
+        get = lambda obj: state[obj] if obj in state else obj.props
+
+        modeset = False
+        for obj, props in self.props.items():
+            if isinstance(obj, Crtc) or isinstance(obj, Connector):
+                if any(obj.props[name] != value for name, value in props.items()):
+                    modeset = True
+
+        if modeset and not allow_modeset:
+            return -errno.EINVAL
+
+        for obj, props in state.items():
+            if isinstance(obj, Connector):
+                crtc = self.card._object(props['CRTC_ID'], Crtc)
+                if props['CRTC_ID'] and crtc not in obj.get_possible_crtcs():
+                    return -errno.EINVAL
+
+            elif isinstance(obj, Crtc):
+                if props['ACTIVE'] and not self.card._object(props['MODE_ID'], Blob):
+                    return -errno.EINVAL
+
+            elif isinstance(obj, Plane):
+                if not props['FB_ID']:
+                    continue
+
+                fb = self.card._object(props['FB_ID'], DumbFramebuffer)
+                crtc = self.card._object(props['CRTC_ID'], Crtc)
+                if not fb or not crtc or not obj.supports_crtc(crtc):
+                    return -errno.EINVAL
+
+                if not get(crtc)['ACTIVE']:
+                    return -errno.EINVAL
+
+                # The source rectangle must be contained in the framebuffer
+                if props['SRC_X'] + props['SRC_W'] > fb.width << 16 or \
+                   props['SRC_Y'] + props['SRC_H'] > fb.height << 16:
+                    return -errno.ENOSPC
+
+                # The plane must be at least partly visible
+                blob = self.card._object(get(crtc)['MODE_ID'], Blob)
+                if not blob:
+                    return -errno.EINVAL
+
+                mode = blob.data
+                x = self.__signed(props['CRTC_X'])
+                y = self.__signed(props['CRTC_Y'])
+                if x >= mode.hdisplay or y >= mode.vdisplay or \
+                   x + props['CRTC_W'] <= 0 or y + props['CRTC_H'] <= 0:
+                    return -errno.EINVAL
+
+        return state
+
+    def __crtcs(self, state):
+        """Return the active CRTCs affected by the request."""
+        crtcs = set()
+        for obj, props in state.items():
+            if isinstance(obj, Crtc):
+                crtc = obj
+            else:
+                crtc = self.card._object(props['CRTC_ID'], Crtc)
+                if not crtc and isinstance(obj, Plane):
+                    crtc = self.card._object(obj.props['CRTC_ID'], Crtc)
+
+            if crtc and (state[crtc] if crtc in state else crtc.props)['ACTIVE']:
+                crtcs.add(crtc)
+
+        return crtcs
+
+    def __apply(self, state):
+        now = time.clock_gettime(time.CLOCK_MONOTONIC)
+
+        for obj, props in state.items():
+            if isinstance(obj, Crtc) and props['ACTIVE'] and \
+               (not obj.props['ACTIVE'] or props['MODE_ID'] != obj.props['MODE_ID']):
+                # Restart the vblank timer with the new mode
+                mode = self.card._object(props['MODE_ID'], Blob).data
+                obj.vblank_start = now
+                obj.vblank_period = 1 / mode.vrefresh
+
+            obj.props = props
+            obj.refs = {name: self.card._object(props[name], cls)
+                        for name, cls in self.REFERENCES.items()
+                        if props.get(name)}
+
+    def test(self, allow_modeset=False):
+        state = self.__check(allow_modeset)
+        return state if isinstance(state, int) else 0
+
+    def commit(self, data=0, allow_modeset=False):
+        state = self.__check(allow_modeset)
+        if isinstance(state, int):
+            return state
+
+        crtcs = self.__crtcs(state)
+        if any(self.card._flip_pending(crtc) for crtc in crtcs):
+            return -errno.EBUSY
+
+        self.__apply(state)
+
+        for crtc in crtcs:
+            self.card._queue_flip(crtc, data)
+
+        return 0
+
+    def commit_sync(self, allow_modeset=False):
+        state = self.__check(allow_modeset)
+        if isinstance(state, int):
+            return state
+
+        crtcs = self.__crtcs(state)
+        self.__apply(state)
+
+        # Wait for the next vblank on all affected CRTCs
+        now = time.clock_gettime(time.CLOCK_MONOTONIC)
+        deadline = max([crtc.next_vblank(now)[1] for crtc in crtcs], default=now)
+        time.sleep(deadline - now)
+
+        return 0
+
+
+def draw_test_pattern(fb):
+    """Draw vertical colour bars, one row at a time."""
+    cpp = FORMAT_CPP[fb.format]
+    colors = (0xffffffff, 0xffffff00, 0xff00ffff, 0xff00ff00,
+              0xffff00ff, 0xffff0000, 0xff0000ff, 0xff000000)
+
+    row = bytearray()
+    for x in range(fb.width):
+        row += colors[x * len(colors) // fb.width].to_bytes(4, 'little')[:cpp]
+
+    stride = fb.stride(0)
+    data = fb.map(0)
+    for y in range(fb.height):
+        data[y * stride:y * stride + len(row)] = row
+
+
+def draw_color_bar(fb, old_xpos, xpos, width):
+    cpp = FORMAT_CPP[fb.format]
+    stride = fb.stride(0)
+    data = fb.map(0)
+
+    black = bytes(width * cpp)
+    white = b'\xff' * (width * cpp)
+
+    for y in range(fb.height):
+        offset = y * stride
+        data[offset + old_xpos * cpp:offset + (old_xpos + width) * cpp] = black
+        data[offset + xpos * cpp:offset + (xpos + width) * cpp] = white
+
+
+def compare_framebuffers(a, b):
+    """Return the fraction of differing bytes between the two frame buffers."""
+    data_a = a.map(0)
+    data_b = b.map(0)
+    if data_a == data_b:
+        return 0.
+
+    size = min(len(data_a), len(data_b))
+    diff = sum(1 for x, y in zip(data_a[:size], data_b[:size]) if x != y)
+    return diff / size
+
+
+def save_raw_frame(fb, filename):
+    with open(filename, 'wb') as f:
+        f.write(fb.map(0))
@@ -0,0 +1,50 @@
+#!/usr/bin/python3
+
+import kmstest
+import pykms
+import time
+
+
+class CompareBenchmark(object):
+    """Compare the time taken by pykms.compare_framebuffers() and by the NumPy
+    FramebufferComparator to compare identical and differing frames."""
+
+    ITERATIONS = 20
+    RESOLUTIONS = ((1280, 720), (1920, 1080), (3840, 2160))
+
+    def __init__(self, card):
+        self.card = card
+
+    def time(self, func):
+        start = time.perf_counter()
+        for i in range(self.ITERATIONS):
+            result = func()
+        return (time.perf_counter() - start) / self.ITERATIONS * 1000, result
+
+    def run(self, width, height):
+        fb = pykms.DumbFramebuffer(self.card, width, height, "XR24")
+        ref = pykms.DumbFramebuffer(self.card, width, height, "XR24")
+        pykms.draw_test_pattern(fb)
+        pykms.draw_test_pattern(ref)
+
+        sampled = kmstest.FramebufferComparator()
+        full = kmstest.FramebufferComparator(sample_step=1)
+
+        for name in ("identical", "differing"):
+            if name == "differing":
+                # Corrupt a small block in the middle of the frame
+                pixels = kmstest.framebuffer_array(fb)
+                pixels[height // 2:height // 2 + 16, width // 2:width // 2 + 16, :3] ^= 0x80
+
+            pykms_time, pykms_diff = self.time(lambda: pykms.compare_framebuffers(fb, ref))
+            sampled_time, sampled_diff = self.time(lambda: sampled.compare(fb, ref))
+            full_time, full_diff = self.time(lambda: full.compare(fb, ref))
+
+            print("%4ux%-4u %-9s: pykms %8.3f ms, sampled %8.3f ms, full %8.3f ms (%s)" %
+                  (width, height, name, pykms_time, sampled_time, full_time, full_diff))
+
+
+card = pykms.Card()
+benchmark = CompareBenchmark(card)
+for width, height in CompareBenchmark.RESOLUTIONS:
+    benchmark.run(width, height)
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+import kmstest
+import pykms
+import time
+
+
+class FlipBenchmark(kmstest.KMSTest):
+    """Measure the CPU time spent in the page flip handler to queue the next
+    flip with atomic_plane_set() and with a prebuilt flip template."""
+
+    FLIPS = 300
+
+    def handle_page_flip(self, frame, timestamp):
+        start = time.thread_time()
+
+        fb = self.fbs[self.front_buf]
+        self.front_buf = self.front_buf ^ 1
+
+        if self.use_template:
+            self.atomic_plane_flip(self.flip_template, fb)
+        else:
+            source = kmstest.Rect(0, 0, fb.width, fb.height)
+            destination = kmstest.Rect(0, 0, fb.width, fb.height)
+            self.atomic_plane_set(self.plane, self.crtc, source, destination, fb)
+
+        self.cpu_time += time.thread_time() - start
+        if self.flips >= self.FLIPS:
+            self.loop.stop()
+
+    def measure(self, use_template):
+        self.use_template = use_template
+        self.cpu_time = 0
+        self.front_buf = 0
+
+        self.atomic_plane_flip(self.flip_template, self.fbs[0])
+        self.run(self.FLIPS / self.mode.vrefresh + 2)
+
+        return self.cpu_time / max(self.flips, 1) * 1000000
+
+    def main(self):
+        for connector in self.card.connectors:
+            if connector.connected():
+                break
+        else:
+            print("No connected connector")
+            return
+
+        self.crtc = connector.get_current_crtc() or connector.get_possible_crtcs()[0]
+        self.plane = self.crtc.primary_plane
+        mode = connector.get_default_mode()
+        self.mode = mode
+
+        self.fbs = [pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, "XR24")
+                    for i in range(2)]
+
+        rect = kmstest.Rect(0, 0, mode.hdisplay, mode.vdisplay)
+        self.flip_template = self.plane_flip_template(self.plane, self.crtc, rect, rect)
+
+        ret = self.atomic_crtc_mode_set(self.crtc, connector, mode, self.fbs[0], sync=True)
+        if ret < 0:
+            print("atomic mode set failed with %d" % ret)
+            return
+
+        plane_set = self.measure(False)
+        template = self.measure(True)
+
+        print("%s %s: atomic_plane_set %.3f us/flip, template %.3f us/flip" %
+              (connector.fullname, mode.name, plane_set, template))
+
+FlipBenchmark().execute()
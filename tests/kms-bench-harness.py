@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import platform
+import selectors
+import socket
+import sys
+import tempfile
+import time
+
+# Benchmark the harness against the virtual KMS device unless another backend
+# is explicitly selected, to get reproducible results.
+os.environ.setdefault("KMSTEST_BACKEND", "fake")
+
+import kmstest
+import pykms
+
+
+class HarnessBenchmark(kmstest.KMSTest):
+    """Measure the CPU time and latency added by the test harness hot paths,
+    in isolation and end-to-end with page flips at 60, 120 and 240 Hz."""
+
+    ITERATIONS = 10000
+    KMSG_BATCH = 100
+    RATES = (60, 120, 240)
+
+    def __init__(self, duration):
+        super().__init__()
+        self.duration = duration
+        self.measurements = {}
+
+    def record(self, name, value, unit):
+        self.measurements[name] = {'value': value, 'unit': unit}
+        print("%-32s %12.3f %s" % (name, value, unit))
+
+    def handle_event_fd(self, fileobj, events):
+        os.eventfd_read(self.event_fd)
+        self.dispatched += 1
+        if self.dispatched == self.ITERATIONS:
+            self.event_loop.stop()
+        else:
+            os.eventfd_write(self.event_fd, 1)
+
+    def bench_event_loop(self):
+        """File descriptor callback dispatch by EventLoop.run()."""
+        self.event_loop = kmstest.EventLoop()
+        self.event_fd = os.eventfd(0)
+        self.event_loop.register(self.event_fd, selectors.EVENT_READ, self.handle_event_fd)
+
+        self.dispatched = 0
+        os.eventfd_write(self.event_fd, 1)
+        start = time.thread_time()
+        self.event_loop.run()
+        cpu_time = time.thread_time() - start
+
+        self.event_loop.close()
+        os.close(self.event_fd)
+
+        self.record("event_loop_dispatch", cpu_time / self.ITERATIONS * 1000000, "us")
+
+    def handle_page_flip(self, frame, timestamp):
+        self.dispatched += 1
+        if self.dispatched == self.ITERATIONS:
+            self.loop.stop()
+        else:
+            self.card.signal_flip(self.crtc, self.crtc.id)
+
+    def bench_flip_dispatch(self):
+        """DRM event read and dispatch to handle_page_flip()."""
+        if not hasattr(self.card, 'signal_flip'):
+            print("flip_dispatch: requires the fake backend, skipping")
+            return
+
+        self.flips = 0
+        self.dispatched = 0
+        self.card.signal_flip(self.crtc, self.crtc.id)
+        start = time.thread_time()
+        self.loop.run()
+        cpu_time = time.thread_time() - start
+
+        self.record("flip_dispatch", cpu_time / self.ITERATIONS * 1000000, "us")
+
+    def bench_logger(self, directory):
+        """Logger.log() with each flush policy."""
+        for policy in kmstest.Logger.POLICIES:
+            logger = kmstest.Logger(os.path.join(directory, policy), policy)
+
+            start = time.thread_time()
+            for i in range(self.ITERATIONS):
+                logger.log("Benchmark message %u" % i)
+            cpu_time = time.thread_time() - start
+
+            logger.close()
+            self.record("logger_log_%s" % policy, cpu_time / self.ITERATIONS * 1000000, "us")
+
+    def bench_plane_set(self):
+        """Property building and test-only commit in atomic_plane_set()."""
+        rect = kmstest.Rect(0, 0, self.fb.width, self.fb.height)
+
+        start = time.thread_time()
+        for i in range(self.ITERATIONS):
+            self.atomic_plane_set(self.crtc.primary_plane, self.crtc, rect, rect,
+                                  self.fb, test_only=True)
+        cpu_time = time.thread_time() - start
+
+        self.record("atomic_plane_set", cpu_time / self.ITERATIONS * 1000000, "us")
+
+    def bench_kmsg_read(self):
+        """KernelLogReader.read(), fed from a packet socket that preserves the
+        record boundaries like /dev/kmsg."""
+        reader = kmstest.KernelLogReader()
+        writer, sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.setblocking(False)
+        os.close(reader.kmsg)
+        reader.kmsg = sock.detach()
+
+        seq = 0
+        cpu_time = 0
+        for batch in range(self.ITERATIONS // self.KMSG_BATCH):
+            for i in range(self.KMSG_BATCH):
+                writer.send(b"6,%u,%u,-;rcar-du feb00000.display: message %u\n" %
+                            (seq, seq * 1000, seq))
+                seq += 1
+
+            start = time.thread_time()
+            msgs = reader.read()
+            cpu_time += time.thread_time() - start
+            assert len(msgs) == self.KMSG_BATCH
+
+        writer.close()
+        self.record("kmsg_read", cpu_time / seq * 1000000, "us")
+
+    def handle_flip(self, frame, timestamp):
+        now = time.clock_gettime(time.CLOCK_MONOTONIC)
+        self.latencies.append(now - timestamp)
+
+        if not self.flipping:
+            return
+
+        fb = self.fbs[self.front_buf]
+        self.front_buf ^= 1
+        self.atomic_plane_flip(self.flip_template, fb)
+
+    def bench_end_to_end(self, connector, rate):
+        """Page flips at the given refresh rate, measuring the CPU time spent
+        in the main thread per flip and the delay between the vblank and the
+        page flip handler."""
+        modes = [mode for mode in connector.get_modes() if mode.vrefresh == rate]
+        if not modes:
+            print("end_to_end_%uhz: no mode available, skipping" % rate)
+            return
+
+        mode = modes[0]
+        self.fbs = [pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, "XR24")
+                    for i in range(2)]
+        rect = kmstest.Rect(0, 0, mode.hdisplay, mode.vdisplay)
+        self.flip_template = self.plane_flip_template(self.crtc.primary_plane, self.crtc,
+                                                      rect, rect)
+
+        ret = self.atomic_crtc_mode_set(self.crtc, connector, mode, self.fbs[0], sync=True)
+        if ret < 0:
+            print("end_to_end_%uhz: atomic mode set failed with %d" % (rate, ret))
+            return
+
+        self.latencies = []
+        self.front_buf = 1
+        self.flipping = True
+        self.set_flip_handler(self.crtc, self.handle_flip)
+        self.atomic_plane_flip(self.flip_template, self.fbs[0])
+
+        start = time.thread_time()
+        self.run(self.duration)
+        cpu_time = time.thread_time() - start
+
+        # Let the last page flip complete before switching to the next mode.
+        self.flipping = False
+        flips = len(self.latencies)
+        self.run(0.1)
+        self.set_flip_handler(self.crtc, None)
+
+        name = "end_to_end_%uhz" % rate
+        self.record(name + "_cpu", cpu_time / max(flips, 1) * 1000000, "us")
+        latencies = sorted(self.latencies)
+        self.record(name + "_latency_p50", kmstest.percentile(latencies, 50) * 1000000, "us")
+        self.record(name + "_latency_p99", kmstest.percentile(latencies, 99) * 1000000, "us")
+        self.record(name + "_missed", max(self.duration * rate - flips, 0), "frames")
+
+    def main(self):
+        for connector in self.card.connectors:
+            if connector.connected():
+                break
+        else:
+            print("No connected connector")
+            return
+
+        self.crtc = connector.get_current_crtc() or connector.get_possible_crtcs()[0]
+        mode = connector.get_default_mode()
+        self.fb = pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, "XR24")
+
+        ret = self.atomic_crtc_mode_set(self.crtc, connector, mode, self.fb, sync=True)
+        if ret < 0:
+            print("atomic mode set failed with %d" % ret)
+            return
+
+        self.bench_event_loop()
+        self.bench_flip_dispatch()
+        with tempfile.TemporaryDirectory() as directory:
+            self.bench_logger(directory)
+        self.bench_plane_set()
+        self.bench_kmsg_read()
+
+        for rate in self.RATES:
+            self.bench_end_to_end(connector, rate)
+
+        self.atomic_crtc_disable(self.crtc)
+
+
+def compare(results, baseline, threshold):
+    """Compare the results with the baseline and return the names of the
+    measurements that regressed by more than the threshold fraction. All
+    measurements are lower-is-better."""
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+
+        ref = baseline[name]['value']
+        value = result['value']
+        if value > ref * (1 + threshold):
+            regressions.append(name)
+            print("%-32s %12.3f %s, baseline %.3f: REGRESSION" %
+                  (name, value, result['unit'], ref))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=HarnessBenchmark.__doc__)
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write results in JSON format to FILE')
+    parser.add_argument('-b', '--baseline', metavar='FILE',
+                        help='compare results with the baseline JSON FILE')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='regression threshold as a fraction of the baseline (default: 0.2)')
+    parser.add_argument('-d', '--duration', type=float, default=5,
+                        help='duration of each end-to-end run in seconds (default: 5)')
+    args = parser.parse_args()
+
+    benchmark = HarnessBenchmark(args.duration)
+    benchmark.execute()
+    benchmark.close()
+
+    results = {
+        'backend': os.environ["KMSTEST_BACKEND"],
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'duration': args.duration,
+        'results': benchmark.measurements,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(benchmark.measurements, baseline['results'], args.threshold):
+            sys.exit(1)
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+import ast
+import kmstest
+import os
+import time
+
+
+def load_corpora():
+    """Load the synthetic kernel logs from kms-test-log-validator.py without
+    executing the tests it contains."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "kms-test-log-validator.py")
+    tree = ast.parse(open(path).read())
+
+    corpora = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) \
+           and isinstance(node.value.value, str):
+            corpora[node.targets[0].id] = node.value.value
+
+    return corpora
+
+
+def make_records(lines, count):
+    """Create count kernel log messages cycling through lines, with one
+    benign message every other record to mimic a busy kernel log."""
+    records = []
+    for i in range(count):
+        if i % 2:
+            text = lines[(i // 2) % len(lines)]
+        else:
+            text = "rcar-du feb00000.display: vblank %u" % i
+        record = "4,%u,%u,-;%s\n" % (i, i * 1000, text)
+        records.append(record.encode("utf-8"))
+
+    return records
+
+
+class FaultMatcherBenchmark(object):
+    """Compare the cost per message of the compiled multi-pattern kernel
+    fault matcher against a linear scan of the patterns."""
+
+    COUNT = 100000
+
+    def __init__(self, name, corpus):
+        self.name = name
+        self.records = make_records(corpus.splitlines(), self.COUNT)
+
+    def run(self):
+        patterns = kmstest.KERNEL_FAULT_PATTERNS
+
+        # Parse the records first, the text is decoded on first access.
+        start = time.perf_counter()
+        msgs = [kmstest.KernelLogMessage(record) for record in self.records]
+        texts = [msg.msg for msg in msgs]
+        parse = time.perf_counter() - start
+
+        start = time.perf_counter()
+        linear = [msg for msg, text in zip(msgs, texts) if any(p in text for p in patterns)]
+        linear_time = time.perf_counter() - start
+
+        matcher = kmstest.KernelFaultMatcher()
+        start = time.perf_counter()
+        faults = matcher.scan(msgs)
+        matcher_time = time.perf_counter() - start
+
+        assert len(faults) == len(linear)
+
+        print("%-14s %6u msgs %5u faults: parse %6.3f us/msg, linear %6.3f us/msg, matcher %6.3f us/msg" %
+              (self.name, len(msgs), len(faults), parse / len(msgs) * 1000000,
+               linear_time / len(msgs) * 1000000, matcher_time / len(msgs) * 1000000))
+
+
+for name, corpus in load_corpora().items():
+    FaultMatcherBenchmark(name, corpus).run()
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+
+import kmstest
+import pykms
+import time
+
+
+class PatternBenchmark(object):
+    """Measure the time to draw test patterns in new framebuffers for all
+    modes of all connected connectors, when rendered with pykms and NumPy
+    (cold) and when copied from the pattern cache (warm)."""
+
+    def __init__(self, card):
+        self.card = card
+
+    def time(self, cache, width, height, pattern):
+        fb = pykms.DumbFramebuffer(self.card, width, height, "XR24")
+        start = time.perf_counter()
+        cache.draw(fb, pattern)
+        return (time.perf_counter() - start) * 1000
+
+    def run(self, connector):
+        print("Connector %s:" % connector.fullname)
+
+        sizes = []
+        for mode in connector.get_modes():
+            if (mode.hdisplay, mode.vdisplay) not in sizes:
+                sizes.append((mode.hdisplay, mode.vdisplay))
+
+        patterns = [("pykms", pykms.draw_test_pattern)]
+        if kmstest.numpy:
+            patterns.append(("numpy", kmstest.draw_color_bars))
+
+        for name, pattern in patterns:
+            cache = kmstest.PatternCache()
+            cold = 0
+            warm = 0
+            for width, height in sizes:
+                cold_time = self.time(cache, width, height, pattern)
+                warm_time = self.time(cache, width, height, pattern)
+                cold += cold_time
+                warm += warm_time
+                print("    %-5s %4ux%-4u: cold %8.3f ms, warm %8.3f ms" %
+                      (name, width, height, cold_time, warm_time))
+
+            print("    %-5s total    : cold %8.3f ms, warm %8.3f ms" % (name, cold, warm))
+
+
+card = pykms.Card()
+benchmark = PatternBenchmark(card)
+for connector in card.connectors:
+    if connector.connected():
+        benchmark.run(connector)
@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+
+import kmstest
+import time
+
+
+class TimerBenchmark(object):
+    """Measure how timer insertion cost and dispatch latency scale with the
+    number of pending timers in the event loop."""
+
+    SAMPLES = 100
+
+    def __init__(self, count):
+        self.count = count
+        self.loop = kmstest.EventLoop()
+
+    def handle_timer(self):
+        clk = time.clock_gettime(time.CLOCK_MONOTONIC)
+        self.latencies.append(clk - self.timer.timeout)
+        self.loop.stop()
+
+    def run(self):
+        # Fill the queue with timers that will not expire during the run.
+        start = time.perf_counter()
+        for i in range(self.count):
+            self.loop.add_timer(3600 + i, lambda: None)
+        insert = (time.perf_counter() - start) / max(self.count, 1)
+
+        # Arm a short timer and measure the delay between its expiration time
+        # and the time its callback gets called. The run() method clears all
+        # timers when it returns, refill the queue for every sample.
+        self.latencies = []
+        for i in range(self.SAMPLES):
+            self.timer = self.loop.add_timer(0.001, self.handle_timer)
+            self.loop.run()
+            for j in range(self.count):
+                self.loop.add_timer(3600 + j, lambda: None)
+
+        self.latencies.sort()
+        median = kmstest.percentile(self.latencies, 50)
+        worst = self.latencies[-1]
+
+        print("%8u timers: insert %8.3f us, dispatch latency median %8.3f us max %8.3f us" %
+              (self.count, insert * 1000000, median * 1000000, worst * 1000000))
+
+
+for count in (0, 10, 100, 1000, 10000):
+    TimerBenchmark(count).run()
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+import argparse
+import glob
+import importlib.util
+import inspect
+import json
+import kmstest
+import os
+import pykms
+import sys
+import time
+import traceback
+import xml.etree.ElementTree as ET
+
+
+class TestSuite(object):
+    """Run test classes from the kms-test-*.py scripts in a single process,
+    sharing the DRM device between all tests, and report results in JSON and
+    JUnit XML formats."""
+
+    # Scripts that are only run when given explicitly. The log validator tests
+    # fail by design, and the suspend/resume test suspends the system.
+    EXCLUDED = (
+        'kms-test-log-validator.py',
+        'kms-test-suspend-resume.py',
+    )
+
+    def __init__(self):
+        self.results = []
+
+    def discover(self, paths):
+        """Load the test scripts and return a list of (script, class) tuples
+        for the test classes they contain, in definition order."""
+        classes = []
+
+        for path in paths:
+            script = os.path.basename(path)
+            name = os.path.splitext(script)[0].replace('-', '_')
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+
+            # Module attributes are stored in definition order
+            for cls in vars(module).values():
+                if inspect.isclass(cls) and issubclass(cls, kmstest.KMSTest) and \
+                   cls.__module__ == name:
+                    classes.append((script, cls))
+
+        return classes
+
+    def run(self, script, cls):
+        start = time.clock_gettime(time.CLOCK_MONOTONIC)
+        test = None
+        results = []
+
+        try:
+            test = cls()
+            results = test.results
+            test.flush_events()
+            test.execute()
+        except Exception as e:
+            traceback.print_exc()
+            results.append({
+                'name': cls.__name__,
+                'status': 'error',
+                'reason': '%s: %s' % (e.__class__.__name__, e),
+                'duration': 0.,
+            })
+        finally:
+            # Release the test resources on the shared card before running the
+            # next test, even if the test failed.
+            if test:
+                test.close()
+
+        duration = time.clock_gettime(time.CLOCK_MONOTONIC) - start
+        self.results.append({
+            'script': script,
+            'class': cls.__name__,
+            'duration': duration,
+            'tests': results,
+        })
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'duration': self.duration, 'suites': self.results}, f, indent=4)
+
+    def write_junit(self, filename):
+        root = ET.Element('testsuites', time='%f' % self.duration)
+
+        for suite in self.results:
+            tests = suite['tests']
+            element = ET.SubElement(root, 'testsuite', name=suite['class'],
+                                    tests=str(len(tests)),
+                                    failures=str(len([t for t in tests if t['status'] == 'fail'])),
+                                    errors=str(len([t for t in tests if t['status'] == 'error'])),
+                                    skipped=str(len([t for t in tests if t['status'] == 'skip'])),
+                                    time='%f' % suite['duration'])
+
+            for test in tests:
+                case = ET.SubElement(element, 'testcase', classname=suite['class'],
+                                     name=str(test['name']), time='%f' % test['duration'])
+                if test['status'] == 'fail':
+                    ET.SubElement(case, 'failure', message=str(test['reason']))
+                elif test['status'] == 'error':
+                    ET.SubElement(case, 'error', message=str(test['reason']))
+                elif test['status'] == 'skip':
+                    ET.SubElement(case, 'skipped', message=str(test['reason']))
+
+        ET.ElementTree(root).write(filename, encoding='utf-8', xml_declaration=True)
+
+    def main(self, args):
+        start = time.clock_gettime(time.CLOCK_MONOTONIC)
+
+        classes = self.discover(args.scripts)
+
+        # Open the device once and share it between all tests
+        kmstest.KMSTest.shared_card = pykms.Card()
+
+        for script, cls in classes:
+            self.run(script, cls)
+
+        self.duration = time.clock_gettime(time.CLOCK_MONOTONIC) - start
+
+        if args.json:
+            self.write_json(args.json)
+        if args.junit:
+            self.write_junit(args.junit)
+
+        failed = [test for suite in self.results for test in suite['tests']
+                  if test['status'] in ('fail', 'error')]
+        return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description=TestSuite.__doc__)
+    parser.add_argument('-j', '--json', metavar='FILE',
+                        help='write results in JSON format to FILE')
+    parser.add_argument('-x', '--junit', metavar='FILE',
+                        help='write results in JUnit XML format to FILE')
+    parser.add_argument('scripts', nargs='*',
+                        default=sorted([path for path in glob.glob(os.path.join(directory, 'kms-test-*.py'))
+                                        if os.path.basename(path) not in TestSuite.EXCLUDED]),
+                        help='test scripts to run (default: all kms-test-*.py scripts except %s)' %
+                             ', '.join(TestSuite.EXCLUDED))
+    args = parser.parse_args()
+
+    sys.exit(TestSuite().main(args))
@@ -46,17 +46,23 @@ class AllPlanesTest(kmstest.KMSTest):
             self.logger.log("Testing connector %s, CRTC %u, mode %s with %u planes" % \
                   (connector.fullname, crtc.id, mode.name, len(planes)))
 
-            # Create a frame buffer
-            fb = pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, "XR24")
-            pykms.draw_test_pattern(fb)
+            # Get a frame buffer from the pool
+            fb = self.fb_pool.acquire(mode.hdisplay, mode.vdisplay, "XR24",
+                                      pykms.draw_test_pattern)
 
             # Set the mode with a primary plane
             ret = self.atomic_crtc_mode_set(crtc, connector, mode, fb)
             if ret < 0:
+                self.fb_pool.release(fb)
                 self.fail("atomic mode set failed with %d" % ret)
                 continue
 
-            self.run(3)
+            if not self.wait_flips(1, 3):
+                self.fb_pool.release(fb)
+                self.fail("Page flip not registered")
+                continue
+
+            self.settle()
 
             # Add all other planes one by one
             offset = 100
@@ -69,15 +75,19 @@ class AllPlanesTest(kmstest.KMSTest):
                     break
 
                 self.logger.log("Adding plane %u" % plane.id)
-                self.run(1)
-
-                if self.flips == 0:
+                if not self.wait_flips(1, 1):
                     self.fail("No page flip registered")
                     break
 
+                self.settle()
+
                 offset += 50
 
             else:
                 self.success()
 
-AllPlanesTest().execute()
+            # The frame buffer can be shared with the next CRTC
+            self.fb_pool.release(fb)
+
+if __name__ == '__main__':
+    AllPlanesTest().execute()
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+import asyncio
+import kmstest
+import pykms
+
+class AsyncPageFlipTest(kmstest.KMSTest):
+    """Test page flipping concurrently on all connectors with the default mode,
+    with one coroutine per CRTC awaiting page flips instead of page flip
+    handlers."""
+
+    FLIPS = 120
+
+    # Tolerated frame rate shortfall, as a fraction of the mode refresh rate
+    FRAME_RATE_TOLERANCE = 0.01
+
+    async def flip(self, connector, crtc, mode):
+        """Set the mode and flip pages between two framebuffers on the CRTC.
+        Return None on success or a failure reason otherwise."""
+        fbs = [self.fb_pool.acquire(mode.hdisplay, mode.vdisplay, "XR24",
+                                    pykms.draw_test_pattern) for i in range(2)]
+
+        try:
+            ret = self.atomic_crtc_mode_set(crtc, connector, mode, fbs[0])
+            if ret < 0:
+                return "atomic mode set failed with %d" % ret
+
+            await asyncio.wait_for(self.wait_flip(crtc), 1)
+
+            rect = kmstest.Rect(0, 0, mode.hdisplay, mode.vdisplay)
+            template = self.plane_flip_template(crtc.primary_plane, crtc, rect, rect)
+            recorder = kmstest.FlipRecorder(self.FLIPS)
+
+            for i in range(self.FLIPS):
+                ret = self.atomic_plane_flip(template, fbs[(i + 1) % 2])
+                if ret < 0:
+                    return "page flip failed with %d" % ret
+
+                frame, time = await asyncio.wait_for(self.wait_flip(crtc), 1)
+                recorder.record(frame, time)
+        except asyncio.TimeoutError:
+            return "page flip timeout"
+        finally:
+            for fb in fbs:
+                self.fb_pool.release(fb)
+
+        stats = recorder.analyze(mode.vrefresh)
+        for line in stats.report():
+            self.logger.log("CRTC %u %s" % (crtc.id, line))
+
+        return stats.check(self.FRAME_RATE_TOLERANCE)
+
+    async def main(self):
+        pipes = []
+        used_crtcs = []
+
+        for connector in self.card.connectors:
+            if not connector.connected():
+                continue
+
+            crtcs = [crtc for crtc in connector.get_possible_crtcs() if crtc not in used_crtcs]
+            if not crtcs:
+                continue
+
+            try:
+                mode = connector.get_default_mode()
+            except ValueError:
+                continue
+
+            used_crtcs.append(crtcs[0])
+            pipes.append((connector, crtcs[0], mode))
+
+        self.start("async page flip on connectors %s" %
+                   ", ".join([connector.fullname for connector, crtc, mode in pipes]))
+
+        if not pipes:
+            self.skip("no connector available")
+            return
+
+        for connector, crtc, mode in pipes:
+            self.logger.log("Testing connector %s on CRTC %u with mode %s" %
+                            (connector.fullname, crtc.id, mode.name))
+
+        # Flip pages on all CRTCs concurrently
+        reasons = await asyncio.gather(*[self.flip(*pipe) for pipe in pipes])
+
+        failures = ["%s: %s" % (connector.fullname, reason)
+                    for (connector, crtc, mode), reason in zip(pipes, reasons) if reason]
+        if failures:
+            self.fail("; ".join(failures))
+        else:
+            self.success()
+
+if __name__ == '__main__':
+    AsyncPageFlipTest().execute()
@@ -94,8 +94,6 @@ class FakeWarningLog(kmstest.KMSTest):
 
         self.success()
 
-FakeWarningLog().execute()
-
 
 class FakePanicLog(kmstest.KMSTest):
     """Generate a fake Kernel Panic as part of a test."""
@@ -108,4 +106,7 @@ class FakePanicLog(kmstest.KMSTest):
 
         self.success()
 
-FakePanicLog().execute()
+
+if __name__ == '__main__':
+    FakeWarningLog().execute()
+    FakePanicLog().execute()
@@ -1,65 +1,204 @@
 #!/usr/bin/python3
 
+import argparse
 import kmstest
 import pykms
+import time
 
-class ModesTest(kmstest.KMSTest):
-    """Test all available modes on all available connectors."""
+class ConnectorSweep(object):
+    """Mode sweep state for one connector and CRTC. Modes are set one after
+    the other, each mode set being started when the page flip of the previous
+    one completes."""
+
+    # Maximum time to wait for the page flip of a mode set, in seconds
+    FLIP_TIMEOUT = 4
+
+    def __init__(self, test, connector, crtc, modes):
+        self.test = test
+        self.logger = test.logger
+        self.connector = connector
+        self.crtc = crtc
+        self.modes = modes
+
+        self.index = -1
+        self.fb = None
+        self.timer = None
+        self.commit_time = None
+        self.latencies = []
+        self.error = None
+        self.done = False
+        self.report_progress = False
+
+    def start(self):
+        self.start_time = time.clock_gettime(time.CLOCK_MONOTONIC)
+        self.test.set_flip_handler(self.crtc, self.handle_page_flip)
+        self.next_mode()
 
-    def handle_page_flip(self, frame, time):
-        self.logger.log("Page flip complete")
+    def finish(self, error=None):
+        if self.fb:
+            self.test.fb_pool.release(self.fb)
+            self.fb = None
 
-    def test_mode(self, connector, crtc, mode):
+        self.test.set_flip_handler(self.crtc, None)
+        self.duration = time.clock_gettime(time.CLOCK_MONOTONIC) - self.start_time
+        self.error = error
+        self.done = True
+
+    def next_mode(self):
+        self.index += 1
+        if self.index == len(self.modes):
+            self.finish()
+            return
+
+        if self.report_progress:
+            self.test.progress(self.index + 1, len(self.modes))
+
+        mode = self.modes[self.index]
         self.logger.log("Testing connector %s on CRTC %u with mode %s" % \
-              (connector.fullname, crtc.id, mode.name))
+              (self.connector.fullname, self.crtc.id, mode.name))
 
-        # Create a frame buffer
-        fb = pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, "XR24")
-        pykms.draw_test_pattern(fb)
+        # Modes are grouped by resolution, only get a new frame buffer from
+        # the pool when the resolution changes.
+        if self.fb and (self.fb.width, self.fb.height) != (mode.hdisplay, mode.vdisplay):
+            self.test.fb_pool.release(self.fb)
+            self.fb = None
+
+        if not self.fb:
+            self.fb = self.test.fb_pool.acquire(mode.hdisplay, mode.vdisplay, "XR24",
+                                                pykms.draw_test_pattern)
 
         # Perform the mode set
-        ret = self.atomic_crtc_mode_set(crtc, connector, mode, fb)
+        self.commit_time = time.clock_gettime(time.CLOCK_MONOTONIC)
+        ret = self.test.atomic_crtc_mode_set(self.crtc, self.connector, mode, self.fb)
         if ret < 0:
-            raise RuntimeError("atomic mode set failed with %d" % ret)
+            self.finish("atomic mode set failed with %d for mode %s" % (ret, mode.name))
+            return
+
+        self.timer = self.test.loop.add_timer(self.FLIP_TIMEOUT, self.handle_timeout)
+
+    def handle_page_flip(self, frame, timestamp):
+        self.timer.cancel()
+
+        mode = self.modes[self.index]
+        latency = timestamp - self.commit_time
+        self.latencies.append(latency)
+        self.logger.log("Mode %s set on CRTC %u in %.3f ms" % (mode.name, self.crtc.id, latency * 1000))
+
+        if self.test.settle_time > 0:
+            self.test.loop.add_timer(self.test.settle_time, self.next_mode)
+        else:
+            self.next_mode()
+
+    def handle_timeout(self):
+        self.finish("Page flip not registered for mode %s" % self.modes[self.index].name)
+
+
+class ModesTest(kmstest.KMSTest):
+    """Test all available modes on all available connectors, sweeping the
+    modes of all connectors in parallel or in sequence."""
+
+    def __init__(self, parallel=True):
+        super().__init__()
+        self.parallel = parallel
+
+    def run_sweeps(self, sweeps):
+        for sweep in sweeps:
+            sweep.start()
+
+        timeout = sum([len(sweep.modes) for sweep in sweeps]) * \
+                  (ConnectorSweep.FLIP_TIMEOUT + self.settle_time) + 1
+        self.wait_until(lambda: all([sweep.done for sweep in sweeps]), timeout)
 
-        self.logger.log("Atomic mode set complete")
-        self.run(4)
+    def complete_sweep(self, sweep):
+        """Log the sweep results and return its error, if any."""
+        if not sweep.done:
+            sweep.finish("Mode sweep timeout")
 
-        if self.flips == 0:
-            raise RuntimeError("Page flip not registered")
+        if sweep.latencies:
+            latencies = sorted(sweep.latencies)
+            self.logger.log("Connector %s: %u modes set in %.3f s, latency median %.3f ms max %.3f ms" %
+                            (sweep.connector.fullname, len(latencies), sweep.duration,
+                             kmstest.percentile(latencies, 50) * 1000, latencies[-1] * 1000))
+
+        return sweep.error
 
     def main(self):
-        for connector in self.card.connectors:
-            self.start("modes on connector %s" % connector.fullname)
+        start = time.clock_gettime(time.CLOCK_MONOTONIC)
+        sweeps = []
+        used_crtcs = []
 
+        for connector in self.card.connectors:
             # Skip disconnected connectors
             if not connector.connected():
+                self.start("modes on connector %s" % connector.fullname)
                 self.skip("unconnected connector")
                 continue
 
-            # Find a CRTC suitable for the connector
+            modes = connector.get_modes()
+            if len(modes) == 0:
+                self.start("modes on connector %s" % connector.fullname)
+                self.skip("no mode available")
+                continue
+
+            # Find a CRTC suitable for the connector and not used by another
+            # sweep
+            crtcs = [crtc for crtc in connector.get_possible_crtcs() if crtc not in used_crtcs]
             crtc = connector.get_current_crtc()
-            if not crtc:
-                crtcs = connector.get_possible_crtcs()
+            if not crtc or crtc not in crtcs:
                 if len(crtcs) == 0:
-                    pass
+                    self.start("modes on connector %s" % connector.fullname)
+                    self.skip("no CRTC available")
+                    continue
 
                 crtc = crtcs[0]
 
-            # Test all available modes
-            modes = connector.get_modes()
-            if len(modes) == 0:
-                self.skip("no mode available")
-                continue
+            used_crtcs.append(crtc)
+
+            # Skip duplicate modes and order the other ones to minimise
+            # framebuffer and clock changes
+            sweep_modes = kmstest.mode_sweep_order(modes)
+            self.logger.log("Connector %s: %u modes, %u duplicates skipped" %
+                            (connector.fullname, len(sweep_modes), len(modes) - len(sweep_modes)))
+
+            sweeps.append(ConnectorSweep(self, connector, crtc, sweep_modes))
+
+        if self.parallel and sweeps:
+            # Report the parallel sweeps as a single test, started before the
+            # sweeps run to record its duration, commit latencies and kernel
+            # faults.
+            self.start("modes on connectors %s" %
+                       ", ".join([sweep.connector.fullname for sweep in sweeps]))
+            self.run_sweeps(sweeps)
 
-            for i in range(len(modes)):
-                try:
-                    self.progress(i+1, len(modes))
-                    self.test_mode(connector, crtc, modes[i])
-                except RuntimeError as e:
-                    self.fail(e.message)
-                    break
+            errors = []
+            for sweep in sweeps:
+                error = self.complete_sweep(sweep)
+                if error:
+                    errors.append("%s: %s" % (sweep.connector.fullname, error))
+
+            if errors:
+                self.fail("; ".join(errors))
             else:
                 self.success()
+        elif not self.parallel:
+            for sweep in sweeps:
+                self.start("modes on connector %s" % sweep.connector.fullname)
+                sweep.report_progress = True
+                self.run_sweeps([sweep])
+
+                error = self.complete_sweep(sweep)
+                if error:
+                    self.fail(error)
+                else:
+                    self.success()
+
+        self.logger.log("Mode sweep completed in %.3f s" %
+                        (time.clock_gettime(time.CLOCK_MONOTONIC) - start))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=ModesTest.__doc__)
+    parser.add_argument('-s', '--sequential', action='store_true',
+                        help='sweep the modes of one connector at a time')
+    args = parser.parse_args()
 
-ModesTest().execute()
+    ModesTest(not args.sequential).execute()
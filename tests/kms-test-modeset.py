@@ -37,22 +37,26 @@ class ModeSetTest(kmstest.KMSTest):
             self.logger.log("Testing connector %s on CRTC %u with mode %s" % \
                   (connector.fullname, crtc.id, mode.name))
 
-            # Create a frame buffer
-            fb = pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, "XR24")
-            pykms.draw_test_pattern(fb)
+            # Get a frame buffer from the pool
+            fb = self.fb_pool.acquire(mode.hdisplay, mode.vdisplay, "XR24",
+                                      pykms.draw_test_pattern)
 
             # Perform a mode set
             ret = self.atomic_crtc_mode_set(crtc, connector, mode, fb)
             if ret < 0:
+                self.fb_pool.release(fb)
                 self.fail("atomic mode set failed with %d" % ret)
                 continue
 
             self.logger.log("Atomic mode set complete")
-            self.run(5)
+            flipped = self.wait_flips(1, 5)
+            self.settle()
+            self.fb_pool.release(fb)
 
-            if self.flips == 0:
+            if not flipped:
                 self.fail("Page flip not registered")
             else:
                 self.success()
 
-ModeSetTest().execute()
+if __name__ == '__main__':
+    ModeSetTest().execute()
@@ -1,118 +1,294 @@
 #!/usr/bin/python3
 
+import argparse
 import kmstest
 import pykms
+import selectors
 
-class PageFlipTest(kmstest.KMSTest):
-    """Test page flipping on all connectors in sequence with the default mode."""
+class CRTCFlipper(object):
+    """Page flip state for one CRTC. Frames are rendered ahead of time into a
+    queue of framebuffers, the page flip handler only commits rendered
+    frames."""
 
     BAR_WIDTH = 20
     BAR_SPEED = 8
 
+    def __init__(self, test, connector, crtc, plane, mode, buffers):
+        self.test = test
+        self.logger = test.logger
+        self.connector = connector
+        self.crtc = crtc
+        self.plane = plane
+        self.mode = mode
+
+        # Create the frame buffers
+        self.fbs = []
+        for i in range(buffers):
+            self.fbs.append(pykms.DumbFramebuffer(test.card, mode.hdisplay, mode.vdisplay, "XR24"))
+
+        # Prebuild the page flip properties
+        rect = kmstest.Rect(0, 0, mode.hdisplay, mode.vdisplay)
+        self.flip_template = test.plane_flip_template(plane, crtc, rect, rect)
+
+        self.recorder = kmstest.FlipRecorder()
+        self.queue = None
+        self.frames = 0
+        self.bar_xpos = {}
+        self.front_fb = None
+        self.pending_fb = None
+        self.waiting = False
+        self.flips = 0
+        self.stop_requested = False
+        self.stopped = False
+
+    def render(self, fb):
+        """Move the color bar to its position for the next frame. Called from
+        the flip queue worker thread."""
+        old_xpos = self.bar_xpos.get(fb.id, 0)
+        new_xpos = (self.frames * self.BAR_SPEED) % (fb.width - self.BAR_WIDTH)
+        self.bar_xpos[fb.id] = new_xpos
+        self.frames += 1
+
+        pykms.draw_color_bar(fb, old_xpos, new_xpos, self.BAR_WIDTH)
+
+    def start(self):
+        """Set the mode and perform the initial page flip."""
+        self.logger.log("Testing connector %s, CRTC %u, plane %u, mode %s, %u buffers" % \
+              (self.connector.fullname, self.crtc.id, self.plane.id, self.mode.name,
+               len(self.fbs)))
+
+        # Render the first frame, and start rendering the next frames ahead in
+        # the other framebuffers.
+        self.render(self.fbs[0])
+        self.front_fb = self.fbs[0]
+        self.queue = kmstest.FlipQueue(self.fbs[1:], self.render)
+        self.test.loop.register(self.queue.fd, selectors.EVENT_READ, self.handle_frame_ready)
+
+        self.test.set_flip_handler(self.crtc, self.handle_page_flip)
+        return self.test.atomic_crtc_mode_set(self.crtc, self.connector, self.mode, self.fbs[0])
+
+    def flip(self, fb):
+        self.pending_fb = fb
+        self.test.atomic_plane_flip(self.flip_template, fb)
+
+    def handle_frame_ready(self, fileobj, events):
+        # Commit the frame if the page flip handler is waiting for it
+        if self.queue.available() and self.waiting:
+            self.waiting = False
+            self.flip(self.queue.get())
+
     def handle_page_flip(self, frame, time):
+        self.flips += 1
+        self.recorder.record(frame, time)
+
+        # The pending frame is now displayed, the previous one can be reused.
+        if self.pending_fb:
+            self.queue.release(self.front_fb)
+            self.front_fb = self.pending_fb
+            self.pending_fb = None
+
         if self.flips == 1:
-            self.logger.log("first page flip frame %u time %f" % (frame, time))
-            self.frame_start = frame
-            self.time_start = time
+            self.logger.log("CRTC %u first page flip frame %u time %f" % (self.crtc.id, frame, time))
 
         if self.stop_requested:
-            self.logger.log("last page flip frame %u time %f" % (frame, time))
-            self.frame_end = frame
-            self.time_end = time
-            self.loop.stop()
-            self.stop_requested = False
+            self.logger.log("CRTC %u last page flip frame %u time %f" % (self.crtc.id, frame, time))
+            self.stop()
             return
 
-        fb = self.fbs[self.front_buf]
-        self.front_buf = self.front_buf ^ 1
+        # Commit the next rendered frame, or wait for the producer to render
+        # one in case of under-run.
+        fb = self.queue.get()
+        if fb:
+            self.flip(fb)
+        else:
+            self.waiting = True
 
-        old_xpos = (self.bar_xpos - self.BAR_SPEED) % (fb.width - self.BAR_WIDTH);
-        new_xpos = (self.bar_xpos + self.BAR_SPEED) % (fb.width - self.BAR_WIDTH);
-        self.bar_xpos = new_xpos
+    def stop(self):
+        self.stop_requested = False
+        self.waiting = False
+        self.stopped = True
+        self.test.flipper_stopped()
 
-        pykms.draw_color_bar(fb, old_xpos, new_xpos, self.BAR_WIDTH)
+    def stop_page_flip(self):
+        # No page flip will complete while waiting for a frame, stop now.
+        if self.waiting:
+            self.stop()
+        else:
+            self.stop_requested = True
 
-        source = kmstest.Rect(0, 0, fb.width, fb.height)
-        destination = kmstest.Rect(0, 0, fb.width, fb.height)
-        self.atomic_plane_set(self.plane, self.crtc, source, destination, fb)
+    def complete(self, tolerance):
+        """Stop dispatching page flips to the flipper and check the results.
+        Return None on success or a failure reason otherwise."""
+        self.test.set_flip_handler(self.crtc, None)
+        if self.queue:
+            self.test.loop.unregister(self.queue.fd)
+            self.queue.close()
+            self.logger.log("CRTC %u rendered %u frames, %u under-runs" %
+                            (self.crtc.id, self.queue.rendered, self.queue.underruns))
 
-    def stop_page_flip(self):
-        self.stop_requested = True
+        if not self.flips:
+            return "No page flip registered"
 
-    def main(self):
-        for connector in self.card.connectors:
-            self.start("page flip on connector %s" % connector.fullname)
+        if self.stop_requested:
+            return "Last page flip not registered"
 
-            # Skip disconnected connectors
-            if not connector.connected():
-                self.skip("unconnected connector")
-                continue
+        stats = self.recorder.analyze(self.mode.vrefresh)
+        for line in stats.report():
+            self.logger.log("CRTC %u %s" % (self.crtc.id, line))
 
-            # Find a CRTC suitable for the connector
-            crtc = connector.get_current_crtc()
-            if not crtc:
-                crtcs = connector.get_possible_crtcs()
-                if len(crtcs) == 0:
-                    pass
+        return stats.check(tolerance)
 
-                crtc = crtcs[0]
 
-            self.crtc = crtc
+class PageFlipTest(kmstest.KMSTest):
+    """Test page flipping on all connectors with the default mode, in sequence
+    or concurrently on all connectors."""
 
-            # Find a plane suitable for the CRTC
-            for plane in self.card.planes:
-                if plane.supports_crtc(crtc):
-                    self.plane = plane
-                    break
-            else:
-                self.skip("no plane available for CRTC %u" % crtc.id)
-                continue
+    # Tolerated frame rate shortfall, as a fraction of the mode refresh rate
+    FRAME_RATE_TOLERANCE = 0.01
 
-            # Get the default mode for the connector
-            try:
-                mode = connector.get_default_mode()
-            except ValueError:
-                self.skip("no mode available")
-                continue
+    def __init__(self, concurrent=False, buffers=3):
+        super().__init__()
+        self.concurrent = concurrent
+        self.buffers = buffers
+        self.flippers = []
+
+    def flipper_stopped(self):
+        # Stop the event loop when all flippers have stopped
+        if all(flipper.stopped for flipper in self.flippers):
+            self.loop.stop()
 
-            self.logger.log("Testing connector %s, CRTC %u, plane %u, mode %s" % \
-                  (connector.fullname, crtc.id, self.plane.id, mode.name))
+    def create_flipper(self, connector, used_crtcs, used_planes):
+        """Create a flipper for the connector, using a CRTC and plane not
+        listed in used_crtcs and used_planes. Return the flipper or a reason
+        for skipping the connector."""
 
-            # Create two frame buffers
-            self.fbs = []
-            for i in range(2):
-                self.fbs.append(pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, "XR24"))
+        # Skip disconnected connectors
+        if not connector.connected():
+            return "unconnected connector"
 
-            # Set the mode and perform the initial page flip
-            ret = self.atomic_crtc_mode_set(crtc, connector, mode, self.fbs[0])
+        # Find a CRTC suitable for the connector
+        crtcs = [crtc for crtc in connector.get_possible_crtcs() if crtc not in used_crtcs]
+        crtc = connector.get_current_crtc()
+        if not crtc or crtc not in crtcs:
+            if len(crtcs) == 0:
+                return "no CRTC available"
+
+            crtc = crtcs[0]
+
+        # Find a plane suitable for the CRTC, preferably its primary plane
+        planes = [plane for plane in self.card.planes
+                  if plane.supports_crtc(crtc) and plane not in used_planes]
+        if len(planes) == 0:
+            return "no plane available for CRTC %u" % crtc.id
+
+        plane = crtc.primary_plane if crtc.primary_plane in planes else planes[0]
+
+        # Get the default mode for the connector
+        try:
+            mode = connector.get_default_mode()
+        except ValueError:
+            return "no mode available"
+
+        return CRTCFlipper(self, connector, crtc, plane, mode, self.buffers)
+
+    def run_flippers(self):
+        # Flip pages for 10s
+        for flipper in self.flippers:
+            self.loop.add_timer(10, flipper.stop_page_flip)
+        self.run(11)
+
+    def complete_flipper(self, flipper):
+        reason = flipper.complete(self.FRAME_RATE_TOLERANCE)
+        if reason:
+            self.fail(reason)
+        else:
+            self.success()
+
+    def main_sequential(self):
+        for connector in self.card.connectors:
+            self.start("page flip on connector %s" % connector.fullname)
+
+            flipper = self.create_flipper(connector, [], [])
+            if isinstance(flipper, str):
+                self.skip(flipper)
+                continue
+
+            ret = flipper.start()
             if ret < 0:
+                flipper.complete(self.FRAME_RATE_TOLERANCE)
                 self.fail("atomic mode set failed with %d" % ret)
                 continue
 
-            # Flip pages for 10s
-            self.bar_xpos = 0
-            self.front_buf = 0
-            self.frame_start = 0
-            self.frame_end = 0
-            self.time_start = 0
-            self.time_end = 0
-            self.stop_requested = False
+            self.flippers = [flipper]
+            self.run_flippers()
+            self.complete_flipper(flipper)
 
-            self.loop.add_timer(10, self.stop_page_flip)
-            self.run(11)
+    def main_concurrent(self):
+        self.flippers = []
+        used_crtcs = []
+        used_planes = []
 
-            if not self.flips:
-                self.fail("No page flip registered")
+        for connector in self.card.connectors:
+            flipper = self.create_flipper(connector, used_crtcs, used_planes)
+            if isinstance(flipper, str):
+                self.start("concurrent page flip on connector %s" % connector.fullname)
+                self.skip(flipper)
                 continue
 
-            if self.stop_requested:
-                self.fail("Last page flip not registered")
-                continue
+            used_crtcs.append(flipper.crtc)
+            used_planes.append(flipper.plane)
+            self.flippers.append(flipper)
+
+        if not self.flippers:
+            return
+
+        # Report the flippers as a single test, started before the flippers
+        # run to record its duration, commit latencies and kernel faults.
+        self.start("concurrent page flip on connectors %s" %
+                   ", ".join([flipper.connector.fullname for flipper in self.flippers]))
+
+        # Start all flippers and flip pages on all CRTCs concurrently
+        failures = []
+        flippers = self.flippers
+        self.flippers = []
+        for flipper in flippers:
+            ret = flipper.start()
+            if ret < 0:
+                flipper.complete(self.FRAME_RATE_TOLERANCE)
+                failures.append("%s: atomic mode set failed with %d" %
+                                (flipper.connector.fullname, ret))
+            else:
+                self.flippers.append(flipper)
 
-            frames = self.frame_end - self.frame_start + 1
-            interval = self.time_end - self.time_start
-            self.logger.log("Frame rate: %f (%u/%u frames in %f s)" % \
-                (frames / interval, self.flips, frames, interval))
+        if self.flippers:
+            self.run_flippers()
+
+        for flipper in self.flippers:
+            reason = flipper.complete(self.FRAME_RATE_TOLERANCE)
+            if reason:
+                failures.append("%s: %s" % (flipper.connector.fullname, reason))
+
+        if failures:
+            self.fail("; ".join(failures))
+        else:
             self.success()
 
-PageFlipTest().execute()
+    def main(self):
+        if self.concurrent:
+            self.main_concurrent()
+        else:
+            self.main_sequential()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=PageFlipTest.__doc__)
+    parser.add_argument('-c', '--concurrent', action='store_true',
+                        help='flip pages on all connectors concurrently')
+    parser.add_argument('-b', '--buffers', type=int, default=3,
+                        help='number of framebuffers to render ahead into (default: 3)')
+    args = parser.parse_args()
+
+    if args.buffers < 2:
+        parser.error('at least 2 buffers are required')
+
+    PageFlipTest(args.concurrent, args.buffers).execute()
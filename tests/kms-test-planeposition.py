@@ -2,7 +2,6 @@
 
 import kmstest
 import pykms
-import time
 
 class PlanePositionTest(kmstest.KMSTest):
     """Test boundaries of plane positioning."""
@@ -43,18 +42,22 @@ class PlanePositionTest(kmstest.KMSTest):
         self.logger.log("Testing connector %s, CRTC %u, mode %s with %u planes" % \
               (connector.fullname, crtc.id, mode.name, len(planes)))
 
-        # Create a frame buffer
-        fb = pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, "XR24")
-        pykms.draw_test_pattern(fb)
+        # Get a frame buffer from the pool, and return it when done, for reuse
+        # by the next test
+        fb = self.fb_pool.acquire(mode.hdisplay, mode.vdisplay, "XR24",
+                                  pykms.draw_test_pattern)
+        self.test_positions(connector, crtc, mode, planes, fb)
+        self.fb_pool.release(fb)
 
-        # Set the mode with no plane, wait 5s for the monitor to wake up
+    def test_positions(self, connector, crtc, mode, planes, fb):
+        # Set the mode with no plane, and let the monitor wake up
         ret = self.atomic_crtc_mode_set(crtc, connector, mode, sync=True)
         if ret < 0:
             self.fail("atomic mode set failed with %d" % ret)
             return
 
         self.logger.log("Initial atomic mode set completed")
-        time.sleep(5)
+        self.settle()
 
         # Add the first plane to cover half of the CRTC
         source = kmstest.Rect(0, 0, fb.width // 2, fb.height)
@@ -65,41 +68,52 @@ class PlanePositionTest(kmstest.KMSTest):
             return
 
         self.logger.log("Root plane enabled")
-        time.sleep(3)
+        self.settle()
+
+        # Check all positions of the second plane with test-only commits first.
+        # The device is expected to accept all positions crossing the CRTC
+        # boundaries, and reject positions that move the plane completely
+        # off-screen.
+        width = fb.width - 100
+        height = fb.height - 100
+        source = kmstest.Rect(0, 0, width, height)
 
-        # Add the second plane and move it around to cross all CRTC boundaries
         offsets = ((50, 50), (150, 50), (50, 150), (-50, 50), (50, -50))
-        for offset in offsets:
-            width = fb.width - 100
-            height = fb.height - 100
-            source = kmstest.Rect(0, 0, width, height)
+        invalid_offsets = ((mode.hdisplay, 50), (50, mode.vdisplay),
+                           (-mode.hdisplay, 50), (50, -mode.vdisplay))
+
+        candidates = []
+        for offset in offsets + invalid_offsets:
             destination = kmstest.Rect(offset[0], offset[1], width, height)
+            candidates.append((planes[1], crtc, source, destination, fb))
 
-            ret = self.atomic_plane_set(planes[1], crtc, source, destination, fb, sync=True)
-            if ret < 0:
+        results = self.atomic_test_batch(self.atomic_plane_set, candidates)
+
+        for offset, accepted in zip(offsets, results):
+            if not accepted:
                 self.fail("atomic plane set with offset %d,%d" % offset)
                 return
 
-            self.logger.log("Moved overlay plane to %d,%d" % offset)
-            time.sleep(3)
+        for offset, accepted in zip(invalid_offsets, results[len(offsets):]):
+            if accepted:
+                self.fail("atomic plane set with invalid offset %d,%d accepted" % offset)
+                return
+
+            self.logger.log("Failed to Move overlay plane to %d,%d as expected" % offset)
 
-        # Try to move the plane completely off-screen. The device is expected to
-        # reject this.
-        offsets = ((mode.hdisplay, 50), (50, mode.vdisplay),
-                   (-mode.hdisplay, 50), (50, -mode.vdisplay))
+        # Add the second plane and move it around to cross all CRTC boundaries
         for offset in offsets:
-            width = fb.width - 100
-            height = fb.height - 100
-            source = kmstest.Rect(0, 0, width, height)
             destination = kmstest.Rect(offset[0], offset[1], width, height)
 
             ret = self.atomic_plane_set(planes[1], crtc, source, destination, fb, sync=True)
-            if ret >= 0:
-                self.fail("atomic plane set with invalid offset %d,%d accepted" % offset)
+            if ret < 0:
+                self.fail("atomic plane set with offset %d,%d" % offset)
                 return
 
-            self.logger.log("Failed to Move overlay plane to %d,%d as expected" % offset)
+            self.logger.log("Moved overlay plane to %d,%d" % offset)
+            self.settle()
 
         self.success()
 
-PlanePositionTest().execute()
+if __name__ == '__main__':
+    PlanePositionTest().execute()
@@ -37,9 +37,9 @@ class StressModeSetTest(kmstest.KMSTest):
             self.logger.log("Testing connector %s on CRTC %u with mode %s" % \
                   (connector.fullname, crtc.id, mode.name))
 
-            # Create a frame buffer
-            fb = pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, "XR24")
-            pykms.draw_test_pattern(fb)
+            # Get a frame buffer from the pool
+            fb = self.fb_pool.acquire(mode.hdisplay, mode.vdisplay, "XR24",
+                                      pykms.draw_test_pattern)
 
             # Track any failures in the iterations
             failures = 0
@@ -52,9 +52,6 @@ class StressModeSetTest(kmstest.KMSTest):
                     failures += 1
                     break
 
-                # Reset the flips counter
-                self.flips = 0
-
                 # Perform a mode set
                 ret = self.atomic_crtc_mode_set(crtc, connector, mode, fb)
                 if ret < 0:
@@ -63,14 +60,15 @@ class StressModeSetTest(kmstest.KMSTest):
                     break
     
                 self.logger.log("Atomic mode set complete")
-                self.run(1)
-
-                if self.flips == 0:
+                if not self.wait_flips(1, 1):
                     self.fail("Page flip not registered")
                     failures += 1
                     break
 
+            self.fb_pool.release(fb)
+
             if failures == 0:
                 self.success()
 
-StressModeSetTest().execute()
+if __name__ == '__main__':
+    StressModeSetTest().execute()
@@ -12,27 +12,28 @@ class PageFlipper(object):
     BAR_WIDTH = 20
     BAR_SPEED = 8
 
+    # Tolerated frame rate shortfall, as a fraction of the mode refresh rate
+    FRAME_RATE_TOLERANCE = 0.01
+
     def __init__(self, test):
         self.test = test
         self.logger = test.logger
         self.loop = test.loop
         self.card = test.card
+        self.recorder = kmstest.FlipRecorder()
 
         # Register ourselves as the parent test's flip handler ... :S
         test.handle_page_flip = self.handle_page_flip
 
     def handle_page_flip(self, frame, time):
         self.flips += 1
+        self.recorder.record(frame, time)
 
         if self.flips == 1:
             self.logger.log("first page flip frame %u time %f" % (frame, time))
-            self.frame_start = frame
-            self.time_start = time
 
         if self.stop_requested:
             self.logger.log("last page flip frame %u time %f" % (frame, time))
-            self.frame_end = frame
-            self.time_end = time
             self.loop.stop()
             self.stop_requested = False
             return
@@ -46,9 +47,7 @@ class PageFlipper(object):
 
         pykms.draw_color_bar(fb, old_xpos, new_xpos, self.BAR_WIDTH)
 
-        source = kmstest.Rect(0, 0, fb.width, fb.height)
-        destination = kmstest.Rect(0, 0, fb.width, fb.height)
-        self.test.atomic_plane_set(self.plane, self.crtc, source, destination, fb)
+        self.test.atomic_plane_flip(self.flip_template, fb)
 
     def stop_page_flip(self):
         self.stop_requested = True
@@ -89,10 +88,8 @@ class PageFlipper(object):
         # Initialise run state
         self.bar_xpos = 0
         self.front_buf = 0
-        self.frame_start = 0
-        self.frame_end = 0
-        self.time_start = 0
-        self.time_end = 0
+        self.mode = mode
+        self.recorder.reset()
         self.flips = 0
         self.previous_flips = 0
         self.stop_requested = False
@@ -102,6 +99,10 @@ class PageFlipper(object):
         for i in range(2):
             self.fbs.append(pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, "XR24"))
 
+        # Prebuild the page flip properties
+        rect = kmstest.Rect(0, 0, mode.hdisplay, mode.vdisplay)
+        self.flip_template = self.test.plane_flip_template(self.plane, crtc, rect, rect)
+
         # Set the mode and perform the initial page flip
         ret = self.test.atomic_crtc_mode_set(crtc, connector, mode, self.fbs[0])
         if ret < 0:
@@ -122,10 +123,13 @@ class PageFlipper(object):
             if self.stop_requested:
                 return self.test.fail("Last page flip not registered")
 
-            frames = self.frame_end - self.frame_start + 1
-            interval = self.time_end - self.time_start
-            self.logger.log("Frame rate: %f (%u/%u frames in %f s)" %
-                            (frames / interval, self.flips, frames, interval))
+            stats = self.recorder.analyze(self.mode.vrefresh)
+            for line in stats.report():
+                self.logger.log(line)
+
+            reason = stats.check(self.FRAME_RATE_TOLERANCE)
+            if reason:
+                return self.test.fail(reason)
 
             return self.test.success()
 
@@ -174,8 +178,10 @@ class SuspendResume(kmstest.KMSTest):
             # Try a suspend cycle
             PMTest().suspend('devices')
 
-            # Reset the run check, and verify the pipeline is still active
+            # Reset the run check and the flip statistics, and verify the
+            # pipeline is still active at full frame rate
             self.flipper.is_running()
+            self.flipper.recorder.reset()
             self.run(5)
             if not self.flipper.is_running():
                 self.fail("Page flip not active after suspend")
@@ -186,4 +192,5 @@ class SuspendResume(kmstest.KMSTest):
             self.run(1)
             self.flipper.verify_completion()
 
-SuspendResume().execute()
+if __name__ == '__main__':
+    SuspendResume().execute()
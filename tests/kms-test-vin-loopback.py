@@ -1,8 +1,10 @@
 #!/usr/bin/python3
 
+import argparse
 import kmstest
 import pykms
 import selectors
+import time
 
 from rcar_vin import RCar_VIN_G3
 
@@ -10,12 +12,70 @@ class VINLoopbackTest(kmstest.KMSTest):
     """ Output a test image on a specific HDMI connector and capture using an HDMI
         cable looped back to the VIN HDMI input device. """
 
+    # Capture buffers are DRM dumb framebuffers, shared with the VIN through
+    # DMABUF by the pykms capture streamer. Captured frames are compared in
+    # place, and can be scanned out directly in passthrough mode, without any
+    # CPU copy. In passthrough mode the captured frames replace the test
+    # pattern on the display, and are captured again through the loopback.
+    #
+    # In latency mode every output frame is stamped with its number. The
+    # number is decoded from the captured frames, to measure the delay between
+    # the page flip and the capture, and detect dropped and duplicated frames.
+    #
+    # In animated mode a bar moves across the output frames. The checksum of
+    # each output frame is computed when it is rendered, and captured frames
+    # are validated by looking their checksum up in an index of the recent
+    # output frames. The checksums skip the undefined X byte. Output frames
+    # are a function of their number only, on a miss the reference frame is
+    # rendered again from the stamped frame number in latency mode, or from
+    # the numbers of the last output frames otherwise, and compared pixel by
+    # pixel with the captured frame within the tolerance.
+
+    # Maximum difference tolerated on the red, green and blue channels
+    COMPARE_TOLERANCE = (0, 0, 0)
+    # Compare one row out of COMPARE_SAMPLE_STEP first, with a different row
+    # offset for each frame. The 10 captured frames thus cover all rows.
+    COMPARE_SAMPLE_STEP = 8
+    # Limits on the number and total size of saved corrupt frames
+    MAX_DUMPS = 4
+    MAX_DUMP_BYTES = 32 << 20
+    # Moving bar parameters and number of output frame checksums to keep in
+    # animated mode
+    BAR_WIDTH = 20
+    BAR_SPEED = 8
+    CHECKSUM_INDEX_SIZE = 16
+    # Number of recent output frames to compare with on a checksum miss when
+    # the frame number isn't known
+    REFERENCE_CANDIDATES = 3
+
+    def __init__(self, queue_depth=2, frames=10, passthrough=False, latency=False,
+                 animate=False):
+        super().__init__()
+        self.queue_depth = queue_depth
+        self.frames = frames
+        self.passthrough = passthrough
+        self.latency = latency
+        self.animate = animate
+
     def handle_page_flip(self, frame, time):
+        # Record the time at which the stamped frame started being displayed
+        if self.pending_stamp is not None:
+            self.stamp_times[self.pending_stamp] = time
+            self.pending_stamp = None
+
         if self.flips == 1:
             self.logger.log("first page flip frame %u time %f" % (frame, time))
             self.frame_start = frame
             self.time_start = time
 
+        # In passthrough mode, the previously displayed captured frame can be
+        # queued back for capture.
+        if self.pending_fb:
+            if self.displayed_fb in self.vin and not self.stop_requested:
+                self.cap.queue(self.displayed_fb)
+            self.displayed_fb = self.pending_fb
+            self.pending_fb = None
+
         if self.stop_requested:
             self.logger.log("last page flip frame %u time %f" % (frame, time))
             self.frame_end = frame
@@ -24,18 +84,83 @@ class VINLoopbackTest(kmstest.KMSTest):
             self.stop_requested = False
             return
 
-        # Flip between two constant (identical) pre-created buffers
+        # Page flips are driven by frame captures in passthrough mode
+        if self.passthrough:
+            return
+
+        # Flip between two pre-created buffers, constant unless animated
         fb = self.fbs[self.front_buf]
         self.front_buf = self.front_buf ^ 1
 
-        source = kmstest.Rect(0, 0, fb.width, fb.height)
-        destination = kmstest.Rect(0, 0, fb.width, fb.height)
-        self.atomic_plane_set(self.plane, self.crtc, source, destination, fb)
+        self.output_frame += 1
+        self.render_frame(fb)
+
+        self.atomic_plane_flip(self.flip_template, fb)
+
+    def draw_frame(self, fb, number):
+        """Draw the animated output frame number in fb, from the test pattern
+        and the bar at its position for the frame only."""
+        xpos = (number * self.BAR_SPEED) % (fb.width - self.BAR_WIDTH)
+        self.patterns.draw(fb)
+        pykms.draw_color_bar(fb, xpos, xpos, self.BAR_WIDTH)
+
+    def render_frame(self, fb):
+        """Render the next output frame in fb and record its checksum in
+        animated mode, and stamp it in latency mode."""
+        if self.animate:
+            self.draw_frame(fb, self.output_frame)
+
+        if self.latency:
+            self.stamp_frame(fb, self.output_frame)
+
+        if self.animate:
+            self.checksums.add(fb, self.output_frame)
+
+    def stamp_frame(self, fb, number):
+        kmstest.FrameStamp.encode(fb, number)
+        self.fb_stamps[fb.id] = number
+        self.pending_stamp = number
+
+    def check_stamp(self, fb, timestamp):
+        """Decode the frame stamp of the captured frame fb, and update the
+        latency and frame drop statistics."""
+        number = kmstest.FrameStamp.decode(fb)
+        if number is None:
+            self.invalid_stamps += 1
+            self.logger.log("Invalid frame stamp")
+            return
+
+        if self.last_stamp is not None:
+            delta = (number - self.last_stamp) & kmstest.FrameStamp.MASK
+            if delta == 0:
+                self.duplicated += 1
+            elif delta > 1:
+                self.dropped += delta - 1
+        self.last_stamp = number
+
+        flip_time = self.stamp_times.pop(number, None)
+        if flip_time is not None:
+            self.latencies.append(timestamp - flip_time)
+
+    def report_latency(self):
+        self.logger.log("Frame stamps: %u captured, %u dropped, %u duplicated, %u invalid" %
+                        (self.captured, self.dropped, self.duplicated, self.invalid_stamps))
+
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            percentiles = [kmstest.percentile(latencies, p) for p in (50, 90, 99, 100)]
+            self.logger.log("Display to capture latency: p50 %.3f ms p90 %.3f ms p99 %.3f ms max %.3f ms" %
+                            tuple(latency * 1000 for latency in percentiles))
 
     def stop_page_flip(self):
         self.stop_requested = True
         self.cap.stream_off()
 
+        # No page flip will complete in passthrough mode if none is pending
+        if self.passthrough and not self.pending_fb:
+            self.loop.stop()
+            self.stop_requested = False
+
     def configure_vin(self, mode):
         vin = RCar_VIN_G3().vin_v4l2_device(0)
         self.logger.log("Using VIN : " + vin)
@@ -47,8 +172,20 @@ class VINLoopbackTest(kmstest.KMSTest):
         self.cap.set_format(self.pixfmt, mode.hdisplay, mode.vdisplay)
         self.cap.set_queue_size(len(self.vin))
         self.captured = 0
+        self.capture_times = []
         self.failures = 0
 
+        # Save corrupt frames from a background thread
+        self.dumper = kmstest.FrameDumper(max_dumps=self.MAX_DUMPS,
+                                          max_bytes=self.MAX_DUMP_BYTES)
+
+        # Use the NumPy comparator when available
+        if kmstest.numpy:
+            self.comparator = kmstest.FramebufferComparator(self.COMPARE_TOLERANCE,
+                                                            self.COMPARE_SAMPLE_STEP)
+        else:
+            self.comparator = None
+
         for fb in self.vin:
             self.cap.queue(fb)
 
@@ -57,26 +194,96 @@ class VINLoopbackTest(kmstest.KMSTest):
         self.loop.register(self.cap.fd, selectors.EVENT_READ, self.handle_frame_capture)
 
 
+    def render_reference(self, number):
+        """Render the output frame number in the reference frame buffer."""
+        self.draw_frame(self.ref_fb, number)
+        if self.latency:
+            kmstest.FrameStamp.encode(self.ref_fb, number)
+        return self.ref_fb
+
+    def compare(self, fb, ref):
+        if self.comparator:
+            return self.comparator.compare(fb, ref)
+        else:
+            return pykms.compare_framebuffers(fb, ref)
+
     def handle_frame_capture(self, fileobj, events):
         if self.stop_requested:
             return
 
         fb = self.cap.dequeue()
-        diff = pykms.compare_framebuffers(fb, self.fbs[self.front_buf])
+        timestamp = time.clock_gettime(time.CLOCK_MONOTONIC)
+        self.capture_times.append(timestamp)
+
+        # Look the captured frame up in the output frames index before the
+        # frame stamp check, as it needs the unmodified frame.
+        frame = self.checksums.lookup(fb) if self.animate else None
+
+        if self.latency:
+            self.check_stamp(fb, timestamp)
+
+        if frame is not None:
+            diff = None
+            self.logger.log("Frame Capture: " + str(self.captured) + " matches output frame " + str(frame))
+        elif self.animate:
+            # The output frame buffers have been redrawn since the frame was
+            # captured, render the reference frames again.
+            number = kmstest.FrameStamp.decode(fb) if self.latency else None
+            if number is not None:
+                candidates = [number]
+            else:
+                candidates = range(self.output_frame,
+                                   max(self.output_frame - self.REFERENCE_CANDIDATES, -1), -1)
+
+            for number in candidates:
+                ref = self.render_reference(number)
+                if self.latency:
+                    kmstest.FrameStamp.encode(fb, number)
+
+                diff = self.compare(fb, ref)
+                if not diff:
+                    break
+
+            self.logger.log("Frame Capture: " + str(self.captured) + " missed the checksum index, " +
+                            "output frame " + str(number) + " with difference " + str(diff))
+        else:
+            # The displayed content doesn't change in passthrough mode if the
+            # captured frames are correct, compare with the initial pattern.
+            if self.passthrough:
+                ref = self.fbs[0]
+            else:
+                ref = self.fbs[self.front_buf]
+
+            # Replace the stamp with the one from the reference frame to
+            # compare the rest of the frame.
+            if self.latency:
+                kmstest.FrameStamp.encode(fb, self.fb_stamps[ref.id])
 
-        self.logger.log("Frame Capture: " + str(self.captured) + " with difference " + str(diff))
+            diff = self.compare(fb, ref)
+            self.logger.log("Frame Capture: " + str(self.captured) + " with difference " + str(diff))
 
         if diff:
-            filename = "/tmp/captured{}.{}x{}.raw".format(str(self.captured), str(self.mode.hdisplay), str(self.mode.vdisplay))
-            pykms.save_raw_frame(fb, filename)
-            self.logger.log("Corrupt frame written to " + filename)
+            name = "captured{}.{}x{}".format(str(self.captured), str(self.mode.hdisplay), str(self.mode.vdisplay))
+            filename = self.dumper.dump(fb, name, ref)
+            if filename:
+                self.logger.log("Corrupt frame queued to " + filename)
+            else:
+                self.logger.log("Corrupt frame dropped")
             self.failures += 1
 
-        self.cap.queue(fb)
         self.captured += 1
 
-        # Stop capturing after 10 frames
-        if self.captured >= 10:
+        # Scan the captured frame out directly in passthrough mode, unless a
+        # page flip is already pending. The frame will be queued back for
+        # capture when it stops being displayed.
+        if self.passthrough and not self.pending_fb and self.captured < self.frames:
+            self.pending_fb = fb
+            self.atomic_plane_flip(self.flip_template, fb)
+        else:
+            self.cap.queue(fb)
+
+        # Stop capturing after the requested number of frames
+        if self.captured >= self.frames:
             self.stop_page_flip()
 
 
@@ -134,19 +341,41 @@ class VINLoopbackTest(kmstest.KMSTest):
         self.logger.log("Testing connector %s, CRTC %u, plane %u, mode %s" % \
               (connector.fullname, crtc.id, self.plane.id, mode.name))
 
-        # Create two frame buffers each for output and capture
-        self.fbs = []
-        self.vin = []
+        # Create two frame buffers for output, and queue_depth frame buffers
+        # for capture
         self.pixfmt = pykms.PixelFormat.XRGB8888
-
-        for i in range(2):
-            self.fbs.append(pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, self.pixfmt))
-            self.vin.append(pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, self.pixfmt))
+        self.fbs = [pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, self.pixfmt)
+                    for i in range(2)]
+        self.vin = [pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay, self.pixfmt)
+                    for i in range(self.queue_depth)]
+        # Frame buffer to render reference frames in animated mode
+        if self.animate:
+            self.ref_fb = pykms.DumbFramebuffer(self.card, mode.hdisplay, mode.vdisplay,
+                                                self.pixfmt)
 
         # Draw test patterns on the output frame buffers
-        # We don't (yet) support comparing against changing patterns
-        pykms.draw_test_pattern(self.fbs[0])
-        pykms.draw_test_pattern(self.fbs[1])
+        self.patterns.draw(self.fbs[0])
+        self.patterns.draw(self.fbs[1])
+
+        # Prebuild the page flip properties
+        rect = kmstest.Rect(0, 0, mode.hdisplay, mode.vdisplay)
+        self.flip_template = self.plane_flip_template(self.plane, crtc, rect, rect)
+
+        # Render the first output frame. Stamp the output frames with their
+        # number in latency mode, and record their checksums in animated mode.
+        self.output_frame = 0
+        self.checksums = kmstest.ChecksumIndex(self.CHECKSUM_INDEX_SIZE)
+        self.pending_stamp = None
+        self.stamp_times = {}
+        self.fb_stamps = {}
+        self.last_stamp = None
+        self.latencies = []
+        self.dropped = 0
+        self.duplicated = 0
+        self.invalid_stamps = 0
+        if self.latency:
+            self.stamp_frame(self.fbs[1], 0)
+        self.render_frame(self.fbs[0])
 
         # Set the mode and perform the initial page flip
         ret = self.atomic_crtc_mode_set(crtc, connector, mode, self.fbs[0])
@@ -156,8 +385,10 @@ class VINLoopbackTest(kmstest.KMSTest):
 
         # Configure
 
-        # Flip pages for 10s
+        # Flip pages until enough frames have been captured
         self.front_buf = 0
+        self.displayed_fb = self.fbs[0]
+        self.pending_fb = None
         self.frame_start = 0
         self.frame_end = 0
         self.time_start = 0
@@ -170,10 +401,26 @@ class VINLoopbackTest(kmstest.KMSTest):
 
         self.configure_vin(mode)
 
-        # Set timeout at 5 seconds.
-        # We stop after capturing 10 frames
-        self.loop.add_timer(5, self.stop_page_flip)
-        self.run(6)
+        # Set the timeout to 5 seconds plus twice the expected capture time.
+        # We stop after capturing the requested number of frames
+        timeout = 5 + 2 * self.frames / mode.vrefresh
+        self.loop.add_timer(timeout, self.stop_page_flip)
+        self.run(timeout + 1)
+
+        self.dumper.close()
+        self.logger.log("Corrupt frames: " + self.dumper.stats())
+
+        if len(self.capture_times) > 1:
+            duration = self.capture_times[-1] - self.capture_times[0]
+            self.logger.log("Captured %u frames in %.3f s (%.3f fps) with queue depth %u" %
+                            (len(self.capture_times), duration,
+                             (len(self.capture_times) - 1) / duration, self.queue_depth))
+
+        if self.latency:
+            self.report_latency()
+
+        if self.animate:
+            self.logger.log("Output frame checksums: " + self.checksums.stats())
 
         if not self.captured:
             self.fail("No frames captured")
@@ -195,4 +442,27 @@ class VINLoopbackTest(kmstest.KMSTest):
 
         self.success()
 
-VINLoopbackTest().execute()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=VINLoopbackTest.__doc__)
+    parser.add_argument('-q', '--queue-depth', type=int, default=2,
+                        help='number of capture buffers (default: 2)')
+    parser.add_argument('-f', '--frames', type=int, default=10,
+                        help='number of frames to capture (default: 10)')
+    parser.add_argument('-p', '--passthrough', action='store_true',
+                        help='display the captured frames instead of the test pattern')
+    parser.add_argument('-l', '--latency', action='store_true',
+                        help='stamp output frames to measure the display to capture latency')
+    parser.add_argument('-a', '--animate', action='store_true',
+                        help='move a bar across the output frames and validate captures by checksum')
+    args = parser.parse_args()
+
+    if args.passthrough and (args.latency or args.animate):
+        parser.error('latency measurement and animation are not supported in passthrough mode')
+
+    # In passthrough mode one capture buffer is displayed, one is pending
+    # display and at least one is queued for capture.
+    if args.queue_depth < (3 if args.passthrough else 1):
+        parser.error('queue depth too small')
+
+    VINLoopbackTest(args.queue_depth, args.frames, args.passthrough, args.latency,
+                    args.animate).execute()
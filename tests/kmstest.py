@@ -1,18 +1,57 @@
 #!/usr/bin/python3
 
+import array
+import asyncio
+import atexit
+import bisect
+import collections
 import errno
 import fcntl
+import gzip
+import heapq
+import inspect
+import math
+import mmap
 import os
-import pykms
+import queue
+import re
 import selectors
+import struct
 import sys
+import threading
 import time
+import weakref
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Use the virtual KMS device when requested, to run the tests without display
+# hardware. Register it as the pykms module for the test scripts.
+if os.environ.get("KMSTEST_BACKEND") == "fake":
+    import fakekms as pykms
+    sys.modules["pykms"] = pykms
+else:
+    import pykms
 
 
 class Timer(object):
-    def __init__(self, timeout, callback):
+    """A one-shot or periodic event loop timer. Timers are returned by
+    EventLoop.add_timer() and can be cancelled with cancel()."""
+
+    def __init__(self, timeout, callback, periodic=False):
         self.timeout = time.clock_gettime(time.CLOCK_MONOTONIC) + timeout
+        self.interval = timeout if periodic else None
         self.callback = callback
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.timeout < other.timeout
+
+    def cancel(self):
+        self.cancelled = True
 
 
 class EventLoop(selectors.DefaultSelector):
@@ -20,39 +59,68 @@ class EventLoop(selectors.DefaultSelector):
         super().__init__()
         self.__timers = []
 
-    def add_timer(self, timeout, callback):
-        self.__timers.append(Timer(timeout, callback))
-        self.__timers.sort(key=lambda timer: timer.timeout)
+    def add_timer(self, timeout, callback, periodic=False):
+        """Schedule callback to be called after timeout seconds. If periodic
+        is True the callback is called every timeout seconds until the timer
+        is cancelled. Return the Timer instance."""
+        if periodic and timeout <= 0:
+            raise ValueError('Periodic timer interval must be positive')
+
+        timer = Timer(timeout, callback, periodic)
+        heapq.heappush(self.__timers, timer)
+        return timer
 
     def fire_timers(self):
         clk = time.clock_gettime(time.CLOCK_MONOTONIC)
         while len(self.__timers) > 0:
             timer = self.__timers[0]
+            if timer.cancelled:
+                heapq.heappop(self.__timers)
+                continue
+
             if timer.timeout > clk:
                 break
 
-            del self.__timers[0]
+            if timer.interval is None:
+                heapq.heappop(self.__timers)
+                timer.callback()
+                continue
+
+            # Reschedule periodic timers before calling the callback, skipping
+            # the periods that have been missed, if any.
+            timer.timeout += timer.interval
+            if timer.timeout <= clk:
+                timer.timeout = clk + timer.interval
+            heapq.heapreplace(self.__timers, timer)
             timer.callback()
 
     def next_timeout(self):
-        clk = time.clock_gettime(time.CLOCK_MONOTONIC)
-        if len(self.__timers) == 0 or self.__timers[0].timeout < clk:
+        while len(self.__timers) > 0 and self.__timers[0].cancelled:
+            heapq.heappop(self.__timers)
+
+        if len(self.__timers) == 0:
             return None
 
-        return self.__timers[0].timeout - clk
+        clk = time.clock_gettime(time.CLOCK_MONOTONIC)
+        return max(self.__timers[0].timeout - clk, 0)
 
-    def run(self, duration=0):
+    def run(self, duration=0, until=None):
+        """Run the event loop until stop() is called, or duration seconds have
+        elapsed if duration is not zero. If until is given, the loop also stops
+        as soon as until() returns True, checked before every iteration."""
         if duration:
             self.add_timer(duration, self.stop)
 
-        timeout = self.next_timeout()
-
         self._stop = False
-        while not self._stop:
-            for key, events in self.select(timeout):
+        while not self._stop and not (until and until()):
+            # Recompute the timeout at every iteration to take timers added by
+            # event handlers or timer callbacks into account.
+            for key, events in self.select(self.next_timeout()):
                 key.data(key.fileobj, events)
             self.fire_timers()
 
+        for timer in self.__timers:
+            timer.cancel()
         self.__timers = []
 
     def stop(self):
@@ -60,101 +128,278 @@ class EventLoop(selectors.DefaultSelector):
 
 
 class KernelLogMessage(object):
-    def __init__(self, msg):
-        pos = msg.find(";")
-        header = msg[:pos]
-        msg = msg[pos+1:]
+    """A /dev/kmsg record. The header fields are parsed when the record is
+    created, the message text and tags are only decoded when accessed."""
+
+    __slots__ = ('facility', 'sequence', 'timestamp', '_body', '_msg', '_tags')
 
-        facility, sequence, timestamp, *other = header.split(",")
+    def __init__(self, record):
+        pos = record.find(b";")
+        facility, sequence, timestamp, *other = record[:pos].split(b",")
         self.facility = int(facility)
         self.sequence = int(sequence)
         self.timestamp = int(timestamp) / 1000000.
 
-        msg = msg.split("\n")
-        self.msg = msg[0]
-        self.tags = {}
+        self._body = record[pos+1:]
+        self._msg = None
+        self._tags = None
 
-        try:
-            tags = msg[1:-1]
-            for tag in tags:
-                tag = tag.strip().split("=")
-                self.tags[tag[0]] = tag[1]
-        except:
-            pass
+    @property
+    def msg(self):
+        if self._msg is None:
+            end = self._body.find(b"\n")
+            if end == -1:
+                end = len(self._body)
+            self._msg = self._body[:end].decode("utf-8", "replace")
+        return self._msg
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = {}
+            for tag in self._body.split(b"\n")[1:-1]:
+                tag = tag.decode("utf-8", "replace").strip().split("=", 1)
+                if len(tag) == 2:
+                    self._tags[tag[0]] = tag[1]
+        return self._tags
 
 
 class KernelLogReader(object):
+    # The kernel limits records to 8kB including the header
+    RECORD_SIZE = 8192
+
     def __init__(self):
         self.kmsg = os.open("/dev/kmsg", 0)
         flags = fcntl.fcntl(self.kmsg, fcntl.F_GETFL)
         fcntl.fcntl(self.kmsg, fcntl.F_SETFL, flags | os.O_NONBLOCK)
         os.lseek(self.kmsg, 0, os.SEEK_END)
 
+        self.__sequence = None
+
+        self.start_time = time.clock_gettime(time.CLOCK_MONOTONIC)
+        self.records = 0
+        self.bytes = 0
+        self.lost = 0
+        self.overruns = 0
+        self.cpu_time = 0.
+
     def __del__(self):
         os.close(self.kmsg)
 
     def read(self):
         msgs = []
+        start = time.thread_time()
+
         while True:
             try:
-                msg = os.read(self.kmsg, 8191)
-                msg = msg.decode("utf-8")
-            except OSError as e:
-                if e.errno == errno.EAGAIN:
-                    break
-                else:
-                    raise e
-            msgs.append(KernelLogMessage(msg))
-
+                record = os.read(self.kmsg, self.RECORD_SIZE)
+            except BlockingIOError:
+                break
+            except BrokenPipeError:
+                # The ring buffer has overrun and the oldest records have been
+                # overwritten. The next read will return the oldest available
+                # record, the number of lost records is computed from the gap
+                # in sequence numbers.
+                self.overruns += 1
+                continue
+
+            msg = KernelLogMessage(record)
+            if self.__sequence is not None and msg.sequence > self.__sequence + 1:
+                self.lost += msg.sequence - self.__sequence - 1
+            self.__sequence = msg.sequence
+
+            self.records += 1
+            self.bytes += len(record)
+            msgs.append(msg)
+
+        self.cpu_time += time.thread_time() - start
         return msgs
 
+    def stats(self):
+        """Return a human-readable summary of the log ingestion statistics."""
+        duration = time.clock_gettime(time.CLOCK_MONOTONIC) - self.start_time
+        return "%u records (%.1f/s, %u bytes), %u lost in %u overruns, %f s CPU time" % \
+            (self.records, self.records / duration if duration else 0, self.bytes,
+             self.lost, self.overruns, self.cpu_time)
+
+
+# Kernel log messages that report a kernel or display pipeline fault
+KERNEL_FAULT_PATTERNS = (
+    "Kernel panic",
+    "Oops",
+    "WARNING:",
+    "BUG:",
+    # rcar-du and vsp1 display pipeline errors
+    "Underrun occurred",
+    "FIFO underrun",
+    "FIFO overflow",
+    "FIFO error",
+)
+
+
+class KernelFault(Exception):
+    """Raised to abort a test when a kernel fault is detected."""
+
+    def __init__(self, test_name, msg):
+        super().__init__("%s (in test %s)" % (msg.msg, test_name))
+        self.test_name = test_name
+        self.msg = msg
+
+
+class KernelFaultMatcher(object):
+    """Detect kernel faults in kernel log messages. All patterns are combined
+    in a single compiled regular expression to keep the cost per message low
+    under high kernel log volume."""
+
+    def __init__(self, patterns=KERNEL_FAULT_PATTERNS):
+        self.__regex = re.compile("|".join(re.escape(p) for p in patterns))
+
+    def match(self, text):
+        """Return True if the kernel log message text reports a fault."""
+        return self.__regex.search(text) is not None
+
+    def scan(self, msgs):
+        """Return the KernelLogMessage instances in msgs that report a fault."""
+        search = self.__regex.search
+        return [msg for msg in msgs if search(msg.msg)]
 
-def KernelLogValidator(test_function):
-    kernel_fault_strings = ("Kernel panic", "Oops", "WARNING:")
 
+def KernelLogValidator(test_function):
     def kernel_log_validator(self):
-        klog = KernelLogReader()
-        fault = False
+        try:
+            test_function(self)
+        except KernelFault as e:
+            self.fail_test(e.test_name, "Kernel fault found: %s" % e)
+            return
 
-        test_function(self)
+        # Kernel faults are detected as the kernel log is read, make sure the
+        # messages logged at the end of the test have been processed.
+        self.logger.event()
 
-        kmsgs = klog.read()
-        for msg in kmsgs:
-            if any(s in msg.msg for s in kernel_fault_strings):
-                fault = True
+        # Fail each test whose log window contained a fault, once.
+        faults = collections.OrderedDict()
+        for test_name, msg in self.kernel_faults:
+            faults.setdefault(test_name, msg)
 
-        if fault:
-            self.fail("Post Test Kernel Fault Found")
+        for test_name, msg in faults.items():
+            self.fail_test(test_name, "Post Test Kernel Fault Found: %s" % msg.msg)
 
     return kernel_log_validator
 
 
 class Logger(object):
-    def __init__(self, name):
+    """Log file writer for tests.
+
+    The flush policy controls how messages reach the log file. With the
+    "line" policy every message is written and flushed immediately. With the
+    "thread" policy messages are queued and written by a background thread,
+    keeping file I/O out of the event loop handlers. With both policies
+    flush() waits for all queued messages to be written and syncs the log file
+    to storage. The default policy is set by the KMSTEST_LOG_POLICY
+    environment variable."""
+
+    POLICIES = ("line", "thread")
+
+    def __init__(self, name, policy=None, kmsg_handler=None):
+        if policy is None:
+            policy = os.environ.get("KMSTEST_LOG_POLICY", "line")
+        if policy not in self.POLICIES:
+            raise ValueError("Invalid log flush policy '%s'" % policy)
+
         self.logfile = open("%s.log" % name, "w")
         self._kmsg = KernelLogReader()
+        self.__queue = None
+
+        # The kernel log handler is stored as a weak reference to avoid
+        # creating a reference cycle with the test that owns the logger.
+        if kmsg_handler:
+            self.__kmsg_handler = weakref.WeakMethod(kmsg_handler)
+        else:
+            self.__kmsg_handler = None
+        self.__thread = None
+
+        if policy == "thread":
+            self.__queue = queue.SimpleQueue()
+            self.__thread = threading.Thread(target=self.__writer,
+                                             name="%s logger" % name, daemon=True)
+            self.__thread.start()
+            # Make sure queued messages are written if the test crashes.
+            atexit.register(self.close)
 
     def __del__(self):
         self.close()
 
+    def __writer(self):
+        while True:
+            # Write all queued messages before flushing the file.
+            item = self.__queue.get()
+            while True:
+                if item is None:
+                    self.logfile.flush()
+                    return
+                elif isinstance(item, threading.Event):
+                    self.logfile.flush()
+                    os.fsync(self.logfile.fileno())
+                    item.set()
+                else:
+                    self.logfile.write(item)
+
+                try:
+                    item = self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            self.logfile.flush()
+
+    def __write(self, data):
+        if self.__queue:
+            self.__queue.put(data)
+        else:
+            self.logfile.write(data)
+            self.logfile.flush()
+
     def close(self):
         if self.logfile:
+            self.event()
+            now = time.clock_gettime(time.CLOCK_MONOTONIC)
+            self.__write("U [%6f] Kernel log: %s\n" % (now, self._kmsg.stats()))
+
+            if self.__thread:
+                self.__queue.put(None)
+                self.__thread.join()
+                self.__thread = None
+                atexit.unregister(self.close)
+
+            # Sync the log to storage once all messages have been written.
+            self.logfile.flush()
+            os.fsync(self.logfile.fileno())
             self.logfile.close()
             self.logfile = None
 
     def event(self):
         kmsgs = self._kmsg.read()
-        for msg in kmsgs:
-            self.logfile.write("K [%6f] %s\n" % (msg.timestamp, msg.msg))
-        self.logfile.flush()
+        if not kmsgs:
+            return
+
+        self.__write("".join(["K [%6f] %s\n" % (msg.timestamp, msg.msg) for msg in kmsgs]))
+
+        handler = self.__kmsg_handler and self.__kmsg_handler()
+        if handler:
+            handler(kmsgs)
 
     @property
     def fd(self):
         return self._kmsg.kmsg
 
     def flush(self):
-        self.logfile.flush()
-        os.fsync(self.logfile)
+        if self.__thread:
+            done = threading.Event()
+            self.__queue.put(done)
+            done.wait()
+        else:
+            self.logfile.flush()
+            os.fsync(self.logfile.fileno())
+            os.fsync(self.logfile)
 
     def log(self, msg):
         # Start by processing the kernel log as there might not be any event
@@ -162,8 +407,100 @@ class Logger(object):
         self.event()
 
         now = time.clock_gettime(time.CLOCK_MONOTONIC)
-        self.logfile.write("U [%6f] %s\n" % (now, msg))
-        self.logfile.flush()
+        self.__write("U [%6f] %s\n" % (now, msg))
+
+
+class ModeBlobCache(object):
+    """Cache of mode property blobs, keyed by the mode timings.
+
+    Blobs are reference-counted: get() returns the blob for a mode and takes
+    a reference, and put() releases it. Unreferenced blobs are kept for reuse
+    and destroyed in least recently used order when the cache holds more than
+    max_blobs blobs. Blobs must stay referenced until the commit that uses
+    them completes, and while their mode is active, for the cache not to
+    destroy them. KMSTest takes care of this for mode sets."""
+
+    def __init__(self, card, max_blobs=16):
+        self.card = card
+        self.max_blobs = max_blobs
+        self.__blobs = collections.OrderedDict()
+
+        self.created = 0
+        self.hits = 0
+        self.destroyed = 0
+
+    @staticmethod
+    def key(mode):
+        return (mode.name, mode.clock, mode.hdisplay, mode.hsync_start, mode.hsync_end,
+                mode.htotal, mode.hskew, mode.vdisplay, mode.vsync_start, mode.vsync_end,
+                mode.vtotal, mode.vscan, mode.vrefresh, mode.flags, mode.type)
+
+    def __evict(self):
+        for key, entry in list(self.__blobs.items()):
+            if len(self.__blobs) <= self.max_blobs:
+                break
+            if entry[1] == 0:
+                del self.__blobs[key]
+                self.destroyed += 1
+
+    def get(self, mode):
+        """Return the blob for mode and take a reference to it."""
+        key = self.key(mode)
+        entry = self.__blobs.get(key)
+        if entry:
+            self.__blobs.move_to_end(key)
+            self.hits += 1
+        else:
+            entry = [mode.to_blob(self.card), 0]
+            self.__blobs[key] = entry
+            self.created += 1
+
+        entry[1] += 1
+        return entry[0]
+
+    def put(self, mode):
+        """Release the reference to the blob for mode taken by get()."""
+        self.__blobs[self.key(mode)][1] -= 1
+        self.__evict()
+
+    def clear(self):
+        """Destroy all unreferenced blobs."""
+        for key, entry in list(self.__blobs.items()):
+            if entry[1] == 0:
+                del self.__blobs[key]
+                self.destroyed += 1
+
+    def stats(self):
+        return "%u created, %u hits, %u destroyed" % (self.created, self.hits, self.destroyed)
+
+
+def mode_sweep_order(modes):
+    """Return the modes in the order they should be tested in. Modes with
+    identical timings are only kept once. Modes are grouped by resolution to
+    reuse framebuffers, with groups and modes within groups sorted by pixel
+    clock to minimise clock changes."""
+    # Ignore the mode name and type, they don't affect the hardware
+    # configuration.
+    unique = {}
+    for mode in modes:
+        unique.setdefault(ModeBlobCache.key(mode)[1:-1], mode)
+
+    groups = {}
+    for mode in unique.values():
+        groups.setdefault((mode.hdisplay, mode.vdisplay), []).append(mode)
+
+    groups = sorted(groups.values(), key=lambda group: min(mode.clock for mode in group))
+    return [mode for group in groups for mode in sorted(group, key=lambda mode: mode.clock)]
+
+
+class PlaneFlipTemplate(object):
+    """Prebuilt plane properties for page flips, created by
+    KMSTest.plane_flip_template()."""
+
+    def __init__(self, plane, crtc, props):
+        self.plane = plane
+        self.crtc = crtc
+        self.props = props
 
 
 class Rect(object):
@@ -174,72 +511,1044 @@ class Rect(object):
         self.height = height
 
 
+def draw_color_bars(fb):
+    """Draw vertical colour bars in a 32-bit RGB or RGB565 framebuffer with
+    NumPy. This is much faster than the pykms pattern generators for large
+    framebuffers."""
+    colors = ((255, 255, 255), (255, 255, 0), (0, 255, 255), (0, 255, 0),
+              (255, 0, 255), (255, 0, 0), (0, 0, 255), (0, 0, 0))
+    bars = numpy.arange(fb.width) * len(colors) // fb.width
+
+    if fb.format == pykms.PixelFormat.RGB565:
+        colors = numpy.array([((r >> 3) << 11) | ((g >> 2) << 5) | (b >> 3)
+                              for r, g, b in colors], dtype=numpy.uint16)
+        data = numpy.frombuffer(fb.map(0), dtype=numpy.uint16)
+        stride = fb.stride(0) // 2
+        pixels = data[:stride * fb.height].reshape(fb.height, stride)[:, :fb.width]
+        pixels[:] = colors[bars]
+    else:
+        # Pixels are stored as B, G, R, X in memory
+        colors = numpy.array([(b, g, r, 255) for r, g, b in colors], dtype=numpy.uint8)
+        framebuffer_array(fb)[:] = colors[bars]
+
+
+class FrameStamp(object):
+    """Machine-readable frame number stamped in the top-left corner of a 32-bit
+    RGB framebuffer. Bits are encoded as black or white square blocks on a
+    first row, followed by a second row with the complemented bits to detect
+    invalid stamps. Decoding only reads one pixel in the middle of each block,
+    which makes it cheap and robust against colour conversion and blur in
+    the capture pipeline."""
+
+    BITS = 16
+    BLOCK_SIZE = 8
+    MASK = (1 << BITS) - 1
+
+    @classmethod
+    def encode(cls, fb, number):
+        """Stamp the frame number, modulo 2^BITS, in the framebuffer."""
+        data = fb.map(0)
+        stride = fb.stride(0)
+
+        for row, value in enumerate((number & cls.MASK, ~number & cls.MASK)):
+            line = b"".join([(b"\xff" if value >> bit & 1 else b"\x00") * (cls.BLOCK_SIZE * 4)
+                             for bit in range(cls.BITS)])
+            for y in range(row * cls.BLOCK_SIZE, (row + 1) * cls.BLOCK_SIZE):
+                data[y * stride:y * stride + len(line)] = line
+
+    @classmethod
+    def decode(cls, fb):
+        """Return the frame number stamped in the framebuffer, or None if the
+        stamp is invalid."""
+        data = fb.map(0)
+        stride = fb.stride(0)
+        values = []
+
+        for row in range(2):
+            # Sample the green channel in the middle of each block
+            offset = (row * cls.BLOCK_SIZE + cls.BLOCK_SIZE // 2) * stride + \
+                     cls.BLOCK_SIZE // 2 * 4 + 1
+            value = 0
+            for bit in range(cls.BITS):
+                if data[offset + bit * cls.BLOCK_SIZE * 4] >= 128:
+                    value |= 1 << bit
+            values.append(value)
+
+        if values[0] ^ values[1] != cls.MASK:
+            return None
+
+        return values[0]
+
+
+class PatternCache(object):
+    """Cache of rendered test patterns.
+
+    Patterns are functions that draw the content of a framebuffer, such as
+    pykms.draw_test_pattern or draw_color_bars. The first time a pattern is
+    drawn for a given framebuffer size and format, it is rendered in the
+    framebuffer and a copy of the framebuffer memory is stored in an anonymous
+    memory map. Subsequent draws copy the cached pattern to the framebuffer
+    memory. Patterns are evicted in least recently used order when the total
+    cache size exceeds max_size bytes."""
+
+    def __init__(self, max_size=128 << 20):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__patterns = collections.OrderedDict()
+
+    def draw(self, fb, pattern=pykms.draw_test_pattern):
+        """Draw pattern in the framebuffer fb."""
+        key = (fb.width, fb.height, str(fb.format), pattern)
+        strides = [fb.stride(plane) for plane in range(fb.num_planes)]
+
+        entry = self.__patterns.get(key)
+        if entry and entry[0] == strides:
+            self.__patterns.move_to_end(key)
+            self.hits += 1
+            for plane, data in enumerate(entry[1]):
+                fb.map(plane)[:len(data)] = data
+            return
+
+        self.misses += 1
+        pattern(fb)
+
+        planes = []
+        for plane in range(fb.num_planes):
+            src = fb.map(plane)
+            data = mmap.mmap(-1, len(src))
+            data[:] = src
+            planes.append(data)
+
+        if entry:
+            self.size -= sum([len(data) for data in entry[1]])
+        self.__patterns[key] = (strides, planes)
+        self.size += sum([len(data) for data in planes])
+
+        while self.size > self.max_size and len(self.__patterns) > 1:
+            key, entry = self.__patterns.popitem(last=False)
+            self.size -= sum([len(data) for data in entry[1]])
+
+    def clear(self):
+        self.__patterns.clear()
+        self.size = 0
+
+    def stats(self):
+        return "%u hits, %u misses, %u bytes" % (self.hits, self.misses, self.size)
+
+
+class FramebufferPool(object):
+    """Pool of dumb framebuffers reused across tests and modes.
+
+    Framebuffers are acquired for a given size and format, and returned to
+    the pool with release() when not needed anymore. Released framebuffers
+    are kept for reuse and destroyed in least recently used order when the
+    total size of the framebuffers exceeds the memory budget. As destroying a
+    framebuffer disables the planes it is displayed on, framebuffers should
+    only be released when not displayed or about to be replaced.
+
+    The pattern passed to acquire() is a function that draws the framebuffer
+    content, such as pykms.draw_test_pattern. It is skipped when a released
+    framebuffer already holds the same pattern. Callers that modify the
+    content of a framebuffer must acquire it without a pattern. When a
+    pattern cache is given, patterns are drawn through it."""
+
+    # Bits per pixel of common formats, summed over all planes, to estimate
+    # the size of framebuffers before allocating them
+    FORMAT_BPP = {
+        'XR24': 32, 'AR24': 32, 'XB24': 32, 'AB24': 32,
+        'RG24': 24, 'BG24': 24, 'RG16': 16, 'BG16': 16,
+        'YUYV': 16, 'UYVY': 16, 'NV16': 16, 'NV61': 16,
+        'NV12': 12, 'NV21': 12,
+    }
+
+    def __init__(self, card, budget=256 << 20, pattern_cache=None):
+        self.card = card
+        self.budget = budget
+        self.pattern_cache = pattern_cache
+
+        # Map released framebuffers to their (key, pattern) in LRU order, and
+        # all framebuffers to their size and content.
+        self.__free = collections.OrderedDict()
+        self.__fbs = {}
+        # Actual size of the framebuffers allocated for each key
+        self.__sizes = {}
+
+        self.size = 0
+        self.peak_size = 0
+        self.acquired = 0
+        self.hits = 0
+        self.pattern_hits = 0
+        self.allocated = 0
+        self.evicted = 0
+
+    def __evict(self, size):
+        while self.__free and self.size + size > self.budget:
+            fb, content = self.__free.popitem(last=False)
+            self.size -= self.__fbs.pop(fb)[0]
+            self.evicted += 1
+
+    def __find(self, key, pattern):
+        # Look for a released framebuffer, preferably with the same content.
+        # This is kept out of acquire() to not hold a reference to the last
+        # framebuffer iterated over, which would prevent its eviction.
+        match = None
+        for fb, content in self.__free.items():
+            if content[0] != key:
+                continue
+            match = fb
+            if pattern and content[1] == pattern:
+                break
+
+        return match
+
+    def acquire(self, width, height, format="XR24", pattern=None):
+        """Return a framebuffer of the given size and format. If pattern is
+        given, the framebuffer content is drawn with it."""
+        key = (width, height, str(format))
+        self.acquired += 1
+
+        fb = self.__find(key, pattern)
+        if fb:
+            del self.__free[fb]
+            self.hits += 1
+        else:
+            # Make room for the new framebuffer before allocating it, to stay
+            # within the budget, and reconcile with the actual size after.
+            size = self.__sizes.get(key) or \
+                width * height * self.FORMAT_BPP.get(key[2], 32) // 8
+            self.__evict(size)
+
+            fb = pykms.DumbFramebuffer(self.card, width, height, format)
+            size = sum([fb.size(plane) for plane in range(fb.num_planes)])
+            self.__sizes[key] = size
+            self.__evict(size)
+            self.__fbs[fb] = [size, key, None]
+            self.size += size
+            self.peak_size = max(self.peak_size, self.size)
+            self.allocated += 1
+
+        info = self.__fbs[fb]
+        if pattern:
+            if info[2] == pattern:
+                self.pattern_hits += 1
+            elif self.pattern_cache:
+                self.pattern_cache.draw(fb, pattern)
+            else:
+                pattern(fb)
+        info[2] = pattern
+
+        return fb
+
+    def release(self, fb):
+        """Return the framebuffer fb to the pool."""
+        size, key, pattern = self.__fbs[fb]
+        self.__free[fb] = (key, pattern)
+        self.__evict(0)
+
+    def clear(self):
+        """Destroy all released framebuffers."""
+        for fb in self.__free:
+            self.size -= self.__fbs.pop(fb)[0]
+            self.evicted += 1
+        self.__free.clear()
+
+    def stats(self):
+        hit_rate = self.hits / self.acquired * 100 if self.acquired else 0
+        return "%u acquired, %u allocated, %.1f%% hits (%u with pattern), %u evicted, peak %u bytes" % \
+            (self.acquired, self.allocated, hit_rate, self.pattern_hits, self.evicted,
+             self.peak_size)
+
+
+def framebuffer_array(fb, plane=0):
+    """Return a (height, width, 4) NumPy array view of a memory-mapped 32-bit
+    RGB framebuffer plane. The pixel data is not copied. NumPy is required."""
+    data = numpy.frombuffer(fb.map(plane), dtype=numpy.uint8)
+    stride = fb.stride(plane)
+    data = data[:stride * fb.height].reshape(fb.height, stride)
+    return data[:, :fb.width * 4].reshape(fb.height, fb.width, 4)
+
+
+class FrameComparison(object):
+    """Framebuffer comparison result computed by FramebufferComparator."""
+
+    def __init__(self, mismatched=0, bounds=None, psnr=math.inf, sampled=False):
+        self.mismatched = mismatched
+        self.bounds = bounds
+        self.psnr = psnr
+        self.sampled = sampled
+
+    def __bool__(self):
+        return self.mismatched != 0
+
+    def __str__(self):
+        if not self.mismatched:
+            return "no difference%s" % (" (sampled)" if self.sampled else "")
+
+        return "%u pixels differ in (%u,%u)/%ux%u, PSNR %.2f dB" % \
+            (self.mismatched, self.bounds.left, self.bounds.top,
+             self.bounds.width, self.bounds.height, self.psnr)
+
+
+class ChecksumIndex(object):
+    """Index of the checksums of recently rendered frames, to validate captured
+    frames without a pixel comparison. Checksums are CRC32 values computed
+    over the red, green and blue channels of the visible area of 32-bit RGB
+    framebuffers, the index keeps the size most recently added frames."""
+
+    # Number of rows checksummed at a time
+    BAND_ROWS = 64
+
+    def __init__(self, size=16):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__index = collections.OrderedDict()
+        self.__scratch = None
+
+    def checksum(self, fb):
+        """Return the checksum of the framebuffer fb. The X byte is undefined
+        in captured frames, it is masked or skipped."""
+        if numpy:
+            pixels = framebuffer_array(fb).view(numpy.uint32)[..., 0]
+            if self.__scratch is None or self.__scratch.shape[1] != fb.width:
+                self.__scratch = numpy.empty((self.BAND_ROWS, fb.width), dtype=numpy.uint32)
+
+            crc = 0
+            for y in range(0, fb.height, self.BAND_ROWS):
+                band = pixels[y:y + self.BAND_ROWS]
+                masked = self.__scratch[:band.shape[0]]
+                numpy.bitwise_and(band, 0x00ffffff, out=masked)
+                crc = zlib.crc32(masked, crc)
+            return crc
+
+        data = fb.map(0)
+        stride = fb.stride(0)
+        width = fb.width * 4
+
+        crc = 0
+        for y in range(fb.height):
+            row = bytearray(data[y * stride:y * stride + width])
+            del row[3::4]
+            crc = zlib.crc32(row, crc)
+        return crc
+
+    def add(self, fb, frame):
+        """Add the checksum of the rendered framebuffer fb for the given frame
+        number."""
+        crc = self.checksum(fb)
+        self.__index[crc] = frame
+        self.__index.move_to_end(crc)
+        while len(self.__index) > self.size:
+            self.__index.popitem(last=False)
+
+    def lookup(self, fb):
+        """Return the number of the frame matching the framebuffer fb, or None
+        if no frame in the index matches."""
+        frame = self.__index.get(self.checksum(fb))
+        if frame is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return frame
+
+    def stats(self):
+        return "%u hits, %u misses" % (self.hits, self.misses)
+
+
+class FramebufferComparator(object):
+    """Compare 32-bit RGB framebuffers with NumPy.
+
+    A fast check compares one row every sample_step rows first, and the full
+    frame is only compared when the sampled rows differ. The sampled rows are
+    offset by one row at every comparison, so that consecutive comparisons of
+    sample_step frames cover all rows. A sample_step of 1 always compares the
+    full frame.
+
+    The tolerance is the maximum absolute difference accepted for each of
+    the red, green and blue channels, to account for colour range
+    conversion and quantisation in the capture pipeline."""
+
+    def __init__(self, tolerance=(0, 0, 0), sample_step=16):
+        if not numpy:
+            raise RuntimeError("NumPy is required to compare framebuffers")
+
+        red, green, blue = tolerance
+        # XRGB8888 is stored as B, G, R, X in memory. The X byte is undefined
+        # in captured frames, a tolerance of 255 ignores it.
+        self.__tolerance = numpy.array((blue, green, red, 255), dtype=numpy.uint8)
+        self.sample_step = sample_step
+        self.__offset = 0
+
+    # Number of rows processed at a time, to bound the size of temporaries
+    BAND_ROWS = 64
+
+    @staticmethod
+    def __diff(fb, ref):
+        # Absolute difference computed in uint8 without overflow
+        diff = numpy.maximum(fb, ref)
+        diff -= numpy.minimum(fb, ref)
+        return diff
+
+    def __mismatches(self, fb, ref):
+        """Return a (height, width) mask of the pixels that differ by more than
+        the tolerance."""
+        mask = numpy.empty(fb.shape[:2], dtype=bool)
+
+        for y in range(0, fb.shape[0], self.BAND_ROWS):
+            band = slice(y, y + self.BAND_ROWS)
+            exceeded = self.__diff(fb[band], ref[band]) > self.__tolerance
+            # Test the four channel flags of each pixel at once
+            mask[band] = exceeded.view(numpy.uint32)[..., 0] != 0
+
+        return mask
+
+    def compare(self, fb, ref):
+        """Compare the framebuffer fb with the reference framebuffer ref and
+        return a FrameComparison. The PSNR is computed over the rows that
+        contain mismatched pixels."""
+        fb = framebuffer_array(fb)
+        ref = framebuffer_array(ref)
+
+        if self.sample_step > 1:
+            offset = self.__offset
+            self.__offset = (offset + 1) % self.sample_step
+
+            step = self.sample_step
+            if not self.__mismatches(fb[offset::step], ref[offset::step]).any():
+                return FrameComparison(sampled=True)
+
+        mask = self.__mismatches(fb, ref)
+        rows = numpy.flatnonzero(mask.any(axis=1))
+        if not rows.size:
+            return FrameComparison()
+
+        mask = mask[rows]
+        mismatched = int(numpy.count_nonzero(mask))
+        cols = numpy.flatnonzero(mask.any(axis=0))
+        bounds = Rect(int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1),
+                      int(rows[-1] - rows[0] + 1))
+
+        diff = self.__diff(fb[rows], ref[rows])[..., :3]
+        mse = numpy.mean(numpy.square(diff, dtype=numpy.float64))
+        psnr = 10 * math.log10(255 ** 2 / mse) if mse else math.inf
+
+        return FrameComparison(mismatched, bounds, psnr)
+
+
+class FrameDumper(object):
+    """Save frames to compressed files from a background thread.
+
+    dump() copies the frame to one of pool_size preallocated buffers and
+    returns immediately, allowing the caller to reuse the framebuffer. Frames
+    are then compressed and written to the dump directory by a worker thread,
+    either as gzip-compressed raw frames ("gz" format) or as PNG images
+    ("png" format, requires NumPy). Frames are dropped when no buffer is free,
+    or when the max_dumps or max_bytes limits are reached."""
+
+    def __init__(self, directory="/tmp", max_dumps=16, max_bytes=64 << 20,
+                 pool_size=2, format="gz"):
+        if format not in ("gz", "png"):
+            raise ValueError("Invalid frame dump format '%s'" % format)
+        if format == "png" and not numpy:
+            raise RuntimeError("NumPy is required to save frames as PNG")
+
+        self.directory = directory
+        self.max_dumps = max_dumps
+        self.max_bytes = max_bytes
+        self.format = format
+
+        # Counters updated by the caller (queued, dropped) and by the worker
+        # thread (dumped, discarded, bytes).
+        self.queued = 0
+        self.dropped = 0
+        self.dumped = 0
+        self.discarded = 0
+        self.bytes = 0
+
+        # Buffers are allocated on first use
+        self.__free = queue.SimpleQueue()
+        for i in range(pool_size):
+            self.__free.put([None, None])
+
+        self.__jobs = queue.SimpleQueue()
+        self.__thread = threading.Thread(target=self.__worker, name="frame dumper",
+                                         daemon=True)
+        self.__thread.start()
+
+    @staticmethod
+    def __copy(buf, fb):
+        size = fb.stride(0) * fb.height
+        if buf is None or len(buf) != size:
+            buf = bytearray(size)
+        buf[:] = fb.map(0)[:size]
+        return buf
+
+    def __encode(self, data, width, height, stride):
+        if self.format == "gz":
+            return gzip.compress(data, compresslevel=1)
+
+        # Convert XRGB8888 to RGB888 rows, each prefixed with a PNG filter
+        # type byte set to 0 (no filtering).
+        pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, stride)
+        pixels = pixels[:, :width * 4].reshape(height, width, 4)
+        rows = numpy.zeros((height, 1 + width * 3), dtype=numpy.uint8)
+        rows[:, 1:] = pixels[..., 2::-1].reshape(height, width * 3)
+
+        def chunk(tag, payload):
+            return struct.pack(">I", len(payload)) + tag + payload + \
+                struct.pack(">I", zlib.crc32(tag + payload))
+
+        return b"\x89PNG\r\n\x1a\n" + \
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + \
+            chunk(b"IDAT", zlib.compress(rows.tobytes(), 1)) + \
+            chunk(b"IEND", b"")
+
+    def __write(self, path, data):
+        if self.bytes + len(data) > self.max_bytes:
+            self.discarded += 1
+            return
+
+        with open(path, "wb") as f:
+            f.write(data)
+
+        self.dumped += 1
+        self.bytes += len(data)
+
+    def __worker(self):
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                return
+
+            slot, path, diff_path, width, height, stride = job
+            frame, ref = slot
+
+            self.__write(path, self.__encode(frame, width, height, stride))
+
+            if diff_path:
+                # The XOR of the frame and the reference is zero where they
+                # match, and compresses to a small file.
+                if numpy:
+                    # XOR in place in the reference buffer, it is overwritten
+                    # when the slot is reused.
+                    diff = numpy.frombuffer(ref, dtype=numpy.uint8)
+                    numpy.bitwise_xor(numpy.frombuffer(frame, dtype=numpy.uint8), diff,
+                                      out=diff)
+                    diff = ref
+                else:
+                    size = len(frame)
+                    diff = int.from_bytes(frame, "little") ^ int.from_bytes(ref, "little")
+                    diff = diff.to_bytes(size, "little")
+                self.__write(diff_path, self.__encode(diff, width, height, stride))
+
+            self.__free.put(slot)
+
+    def path(self, name):
+        """Return the path of the file a frame dumped as name is written to."""
+        suffix = ".raw.gz" if self.format == "gz" else ".png"
+        return os.path.join(self.directory, name + suffix)
+
+    def dump(self, fb, name, ref=None):
+        """Queue a copy of the framebuffer fb for saving as name in the dump
+        directory. If the reference framebuffer ref is given, the difference
+        between fb and ref is also saved as name.diff. Return the path of the
+        frame file, or None if the frame is dropped."""
+        if self.queued >= self.max_dumps or self.bytes >= self.max_bytes:
+            self.dropped += 1
+            return None
+
+        try:
+            slot = self.__free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return None
+
+        slot[0] = self.__copy(slot[0], fb)
+        if ref and (ref.stride(0), ref.height) == (fb.stride(0), fb.height):
+            slot[1] = self.__copy(slot[1], ref)
+            diff_path = self.path(name + ".diff")
+        else:
+            diff_path = None
+
+        self.queued += 1
+        path = self.path(name)
+        self.__jobs.put((slot, path, diff_path, fb.width, fb.height, fb.stride(0)))
+        return path
+
+    def close(self):
+        """Wait for all queued frames to be written and stop the worker."""
+        if self.__thread:
+            self.__jobs.put(None)
+            self.__thread.join()
+            self.__thread = None
+
+    def stats(self):
+        return "%u frames queued, %u dropped, %u files written (%u bytes), %u discarded" % \
+            (self.queued, self.dropped, self.dumped, self.bytes, self.discarded)
+
+
+def percentile(values, p):
+    """Return the p-th percentile (in percents) of the sorted sequence values
+    with the nearest-rank method. values must not be empty."""
+    return values[min(len(values) * p // 100, len(values) - 1)]
+
+
+class FlipStatistics(object):
+    """Page flip timing statistics computed by FlipRecorder.analyze()."""
+
+    # Jitter histogram bin edges, in microseconds relative to the expected
+    # frame period
+    JITTER_BINS = (-1000, -500, -100, 100, 500, 1000)
+
+    def __init__(self, frames, times, refresh):
+        self.flips = len(frames)
+        self.refresh = refresh
+        self.period = 1. / refresh if refresh else 0.
+        self.frames = frames[-1] - frames[0] + 1 if self.flips else 0
+        self.duration = times[-1] - times[0] if self.flips else 0.
+        self.frame_rate = (self.flips - 1) / self.duration if self.duration else 0.
+
+        if self.flips < 2:
+            self.missed = 0
+            self.percentiles = {}
+            self.histogram = [0] * (len(self.JITTER_BINS) + 1)
+            return
+
+        if numpy:
+            frames = numpy.frombuffer(frames, dtype=numpy.uint64).astype(numpy.int64)
+            times = numpy.frombuffer(times, dtype=numpy.float64)
+            gaps = numpy.diff(frames)
+            intervals = numpy.diff(times)
+            self.missed = int(numpy.maximum(gaps - 1, 0).sum())
+            sorted_intervals = numpy.sort(intervals)
+            self.percentiles = {p: float(percentile(sorted_intervals, p))
+                                for p in (50, 90, 99, 100)}
+            jitter = (intervals - self.period) * 1000000
+            bins = numpy.searchsorted(self.JITTER_BINS, jitter, side='right')
+            self.histogram = numpy.bincount(bins, minlength=len(self.JITTER_BINS) + 1).tolist()
+        else:
+            gaps = [b - a for a, b in zip(frames, frames[1:])]
+            intervals = sorted(b - a for a, b in zip(times, times[1:]))
+            self.missed = sum(max(gap - 1, 0) for gap in gaps)
+            self.percentiles = {p: percentile(intervals, p) for p in (50, 90, 99, 100)}
+            self.histogram = [0] * (len(self.JITTER_BINS) + 1)
+            for interval in intervals:
+                jitter = (interval - self.period) * 1000000
+                self.histogram[bisect.bisect_right(self.JITTER_BINS, jitter)] += 1
+
+    def report(self):
+        """Return a list of human-readable lines describing the statistics."""
+        lines = ["Frame rate: %f (%u/%u frames in %f s, expected %f)" %
+                 (self.frame_rate, self.flips, self.frames, self.duration, self.refresh)]
+
+        if self.percentiles:
+            lines.append("Flip interval: p50 %.3f ms p90 %.3f ms p99 %.3f ms max %.3f ms" %
+                         tuple(self.percentiles[p] * 1000 for p in (50, 90, 99, 100)))
+
+            labels = ["< %d" % self.JITTER_BINS[0]]
+            labels += ["%d..%d" % (self.JITTER_BINS[i], self.JITTER_BINS[i + 1])
+                       for i in range(len(self.JITTER_BINS) - 1)]
+            labels.append(">= %d" % self.JITTER_BINS[-1])
+            lines.append("Flip jitter (us): " + ", ".join(["%s: %u" % (label, count)
+                         for label, count in zip(labels, self.histogram)]))
+
+        lines.append("Missed vblanks: %u" % self.missed)
+        return lines
+
+    def check(self, tolerance=0.01):
+        """Check the page flip rate against the expected refresh rate. Return
+        None if the flip rate is within the tolerance (expressed as a fraction
+        of the refresh rate), or a failure reason otherwise."""
+        if not self.refresh:
+            return None
+
+        if self.frame_rate < self.refresh * (1 - tolerance):
+            return "frame rate %f below expected %f (%u missed vblanks)" % \
+                (self.frame_rate, self.refresh, self.missed)
+
+        return None
+
+
+class FlipRecorder(object):
+    """Record the sequence number and timestamp of every page flip in a
+    preallocated ring buffer. Only the last capacity flips are kept."""
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.__frames = array.array('Q', [0]) * capacity
+        self.__times = array.array('d', [0.]) * capacity
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+
+    def record(self, frame, time):
+        index = self.count % self.capacity
+        self.__frames[index] = frame
+        self.__times[index] = time
+        self.count += 1
+
+    def analyze(self, refresh):
+        """Compute the page flip statistics for the recorded flips against the
+        expected refresh rate (in Hz). Return a FlipStatistics instance."""
+        if self.count <= self.capacity:
+            frames = self.__frames[:self.count]
+            times = self.__times[:self.count]
+        else:
+            index = self.count % self.capacity
+            frames = self.__frames[index:] + self.__frames[:index]
+            times = self.__times[index:] + self.__times[:index]
+
+        return FlipStatistics(frames, times, refresh)
+
+
+class CommitLatency(object):
+    """Commit to completion latency recorder for atomic commits. Non-blocking
+    commits are matched with the next page flip event on their CRTC, the
+    latency of blocking commits is the duration of the commit call. Latency
+    distributions are kept per CRTC and commit type ("modeset" or "plane") in
+    preallocated ring buffers. Only the last capacity latencies of each
+    distribution are kept."""
+
+    PERCENTILES = (50, 90, 99, 100)
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.__pending = {}
+        # Ring buffers and total number of recorded latencies, keyed by
+        # (CRTC ID, commit type)
+        self.__samples = {}
+        self.__counts = {}
+
+    def commit(self, crtc_id, type):
+        """Record a non-blocking commit on the CRTC."""
+        self.__pending[crtc_id] = (type, time.clock_gettime(time.CLOCK_MONOTONIC))
+
+    def complete(self, crtc_id, timestamp):
+        """Match the completion event received at timestamp with the pending
+        commit on the CRTC, if any."""
+        pending = self.__pending.pop(crtc_id, None)
+        if pending:
+            type, start = pending
+            self.record(crtc_id, type, timestamp - start)
+
+    def record(self, crtc_id, type, latency):
+        key = (crtc_id, type)
+        count = self.__counts.get(key, 0)
+        if not count:
+            self.__samples[key] = array.array('d', [0.]) * self.capacity
+
+        self.__samples[key][count % self.capacity] = latency
+        self.__counts[key] = count + 1
+
+    def counts(self):
+        """Return the number of latencies recorded so far, to be passed to
+        summary() as a start point."""
+        return dict(self.__counts)
+
+    def summary(self, start=None):
+        """Return the latency percentiles of the samples recorded since start,
+        as returned by counts(), as a dictionary of dictionaries keyed by CRTC
+        and commit type. The percentiles only cover the last capacity samples
+        of each distribution."""
+        summary = {}
+        for key, count in sorted(self.__counts.items()):
+            recorded = count - (start or {}).get(key, 0)
+            if not recorded:
+                continue
+
+            samples = self.__samples[key]
+            if count > self.capacity:
+                index = count % self.capacity
+                samples = samples[index:] + samples[:index]
+            end = min(count, self.capacity)
+            latencies = sorted(samples[end - min(recorded, self.capacity):end])
+
+            stats = summary["CRTC %u %s" % key] = {'count': recorded}
+            for p in self.PERCENTILES:
+                stats['p%u' % p] = percentile(latencies, p)
+
+        return summary
+
+    def report(self, start=None):
+        """Return a list of human-readable lines describing the latencies."""
+        return ["%s commit latency: %u commits, p50 %.3f ms p90 %.3f ms p99 %.3f ms max %.3f ms" %
+                ((key, stats['count']) + tuple(stats['p%u' % p] * 1000 for p in self.PERCENTILES))
+                for key, stats in self.summary(start).items()]
+
+
+class FlipQueue(object):
+    """Render-ahead queue of framebuffers for page flipping.
+
+    Frames are rendered by a worker thread into the free framebuffers ahead of
+    time, so that page flip handlers only have to commit an already rendered
+    framebuffer with get(). Framebuffers are returned to the queue with
+    release() when they stop being displayed. The fd attribute is readable
+    when rendered frames are available, and available() must be called when
+    it is. Calls to get() that find no rendered frame are counted as
+    under-runs, telling producer stalls apart from display pipeline stalls."""
+
+    def __init__(self, fbs, render):
+        self.render = render
+        self.rendered = 0
+        self.underruns = 0
+        self.__thread = None
+
+        self.__free = queue.SimpleQueue()
+        self.__ready = collections.deque()
+        self.__read_fd, self.__write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        for fb in fbs:
+            self.__free.put(fb)
+
+        self.__thread = threading.Thread(target=self.__worker, name="flip queue",
+                                         daemon=True)
+        self.__thread.start()
+
+    def __del__(self):
+        self.close()
+
+    def __worker(self):
+        while True:
+            fb = self.__free.get()
+            if fb is None:
+                return
+
+            self.render(fb)
+            self.rendered += 1
+            self.__ready.append(fb)
+
+            # The pipe only needs to be readable, ignore writes to a full pipe.
+            try:
+                os.write(self.__write_fd, b"\0")
+            except BlockingIOError:
+                pass
+
+    @property
+    def fd(self):
+        return self.__read_fd
+
+    def available(self):
+        """Clear the fd readable state and return the number of rendered
+        frames."""
+        try:
+            while os.read(self.__read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        return len(self.__ready)
+
+    def get(self):
+        """Return the next rendered framebuffer, or None if no frame is ready."""
+        try:
+            return self.__ready.popleft()
+        except IndexError:
+            self.underruns += 1
+            return None
+
+    def release(self, fb):
+        """Return a framebuffer to the queue for rendering."""
+        self.__free.put(fb)
+
+    def close(self):
+        if self.__thread:
+            self.__free.put(None)
+            self.__thread.join()
+            self.__thread = None
+            os.close(self.__read_fd)
+            os.close(self.__write_fd)
+
+
 class KMSTest(object):
+    """Base class for KMS tests. Test classes implement a main() method that
+    runs the test. When main() is a coroutine function the test runs on an
+    asyncio event loop, and can await page flips and frame captures with
+    wait_flip() and wait_capture() instead of implementing callbacks.
+
+    The kernel log is scanned for faults matching kernel_fault_patterns while
+    the test runs. Faults are attributed to the current test and cause the
+    test execution to fail. When abort_on_kernel_fault is set the test is
+    aborted as soon as a fault is detected."""
+
+    kernel_fault_patterns = KERNEL_FAULT_PATTERNS
+    abort_on_kernel_fault = False
+
+    # Memory budget of the framebuffer pool, in bytes
+    fb_pool_budget = 256 << 20
+
+    # Card shared by all tests instead of opening the device for each test
+    shared_card = None
+
+    # Time given to monitors to display the output after configuration
+    # changes, in seconds. Tests don't need to wait for anything but page flips
+    # with a virtual or captured display, this is useful with physical
+    # monitors that take time to sync, or for visual inspection.
+    settle_time = float(os.environ.get("KMSTEST_SETTLE_TIME", 0))
+
     def __init__(self, use_default_key_handler=False):
         if not getattr(self, 'main', None):
             raise RuntimeError('Test class must implement main method')
 
-        self.card = pykms.Card()
+        self.card = self.shared_card or pykms.Card()
         if not self.card.has_atomic:
             raise RuntimeError("Device doesn't support the atomic API")
 
+        self.mode_blobs = ModeBlobCache(self.card)
+        # Modes active on the CRTCs, and modes of pending commits, by CRTC ID
+        self.__active_modes = {}
+        self.__pending_modes = {}
+        # Flip templates whose properties are applied to the planes, by plane ID
+        self.__flip_templates = {}
+        self.patterns = PatternCache()
+        self.fb_pool = FramebufferPool(self.card, self.fb_pool_budget, self.patterns)
+
+        self.test_name = None
+        self.test_start = None
+        self.results = []
+        self.commit_latency = CommitLatency()
+        self.__latency_start = None
+        self.kernel_faults = []
+        self.__kernel_fault = None
+        self.__fault_matcher = KernelFaultMatcher(self.kernel_fault_patterns)
+
         logname = self.__class__.__name__
-        self.logger = Logger(logname)
+        self.logger = Logger(logname, kmsg_handler=self.__check_kernel_log)
 
         self.loop = EventLoop()
+        self.flips = 0
+        self.async_loop = None
+        self.__main_task = None
+        self.__flip_waiters = []
+        self.__crtc_flip_handlers = {}
         self.loop.register(self.logger.fd, selectors.EVENT_READ, self.__read_logger)
         self.loop.register(self.card.fd, selectors.EVENT_READ, self.__read_event)
         if use_default_key_handler:
             self.loop.register(sys.stdin, selectors.EVENT_READ, self.__read_key)
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """Release the resources allocated by the test."""
+        self.fb_pool.clear()
+        self.__release_modes()
+        self.mode_blobs.clear()
+        self.patterns.clear()
         self.logger.close()
 
     def __format_props(self, props):
         return {k: v & ((1 << 64) - 1) for k, v in props.items()}
 
-    def atomic_crtc_disable(self, crtc, sync=True):
-        req = pykms.AtomicReq(self.card)
-        req.add(crtc, 'ACTIVE', False)
+    def __commit(self, req, sync, allow_modeset=False, test_only=False, crtc=None):
+        if test_only:
+            return req.test(allow_modeset)
+
+        type = "modeset" if allow_modeset else "plane"
+
         if sync:
-            return req.commit_sync(True)
+            start = time.clock_gettime(time.CLOCK_MONOTONIC)
+            ret = req.commit_sync(allow_modeset)
+            if crtc and ret == 0:
+                self.commit_latency.record(crtc.id, type,
+                                           time.clock_gettime(time.CLOCK_MONOTONIC) - start)
         else:
-            return req.commit(0, True)
-
-    def atomic_crtc_mode_set(self, crtc, connector, mode, fb=None, sync=False):
+            # Pass the CRTC ID as user data to identify the CRTC in the page
+            # flip event.
+            ret = req.commit(crtc.id if crtc else 0, allow_modeset)
+            if crtc and ret == 0:
+                self.commit_latency.commit(crtc.id, type)
+
+        return ret
+
+    def __set_active_mode(self, crtc_id, mode):
+        # Keep the reference to the blob of the mode active on the CRTC, and
+        # release the reference to the previously active mode, if any. A mode
+        # set that completed synchronously supersedes pending ones.
+        pending_mode = self.__pending_modes.pop(crtc_id, None)
+        if pending_mode:
+            self.mode_blobs.put(pending_mode)
+
+        old_mode = self.__active_modes.pop(crtc_id, None)
+        if mode:
+            self.__active_modes[crtc_id] = mode
+        if old_mode:
+            self.mode_blobs.put(old_mode)
+
+    def __set_pending_mode(self, crtc_id, mode):
+        # Record the mode of a non-blocking commit, to make it active when the
+        # commit completes.
+        if crtc_id in self.__pending_modes:
+            self.__complete_mode_set(crtc_id)
+        self.__pending_modes[crtc_id] = mode
+
+    def __complete_mode_set(self, crtc_id):
+        if crtc_id in self.__pending_modes:
+            mode = self.__pending_modes.pop(crtc_id)
+            self.__set_active_mode(crtc_id, mode)
+
+    def __release_modes(self):
+        for crtc_id in list(self.__pending_modes):
+            self.__complete_mode_set(crtc_id)
+        for crtc_id in list(self.__active_modes):
+            self.__set_active_mode(crtc_id, None)
+
+    def atomic_crtc_disable(self, crtc, sync=True, test_only=False):
+        req = pykms.AtomicReq(self.card)
+        req.add(crtc, 'ACTIVE', False)
+        ret = self.__commit(req, sync, True, test_only, crtc)
+        if not test_only and ret == 0:
+            self.__flip_templates.clear()
+            if sync:
+                self.__set_active_mode(crtc.id, None)
+            else:
+                self.__set_pending_mode(crtc.id, None)
+        return ret
+
+    def atomic_crtc_mode_set(self, crtc, connector, mode, fb=None, sync=False, test_only=False):
         """Perform a mode set on the given connector and CRTC. The framebuffer,
         if present, will be output on the primary plane. Otherwise no plane is
         configured for the CRTC."""
 
         # Mode blobs are reference-counted, make sure the blob stays valid until
         # the commit completes.
-        mode_blob = mode.to_blob(self.card)
-
-        req = pykms.AtomicReq(self.card)
-        req.add(connector, 'CRTC_ID', crtc.id)
-        req.add(crtc, {'ACTIVE': 1, 'MODE_ID': mode_blob.id})
-        if fb:
-            req.add(crtc.primary_plane, {
-                        'FB_ID': fb.id,
-                        'CRTC_ID': crtc.id,
-                        'SRC_X': 0,
-                        'SRC_Y': 0,
-                        'SRC_W': int(fb.width * 65536),
-                        'SRC_H': int(fb.height * 65536),
-                        'CRTC_X': 0,
-                        'CRTC_Y': 0,
-                        'CRTC_W': fb.width,
-                        'CRTC_H': fb.height,
-            })
-        if sync:
-            return req.commit_sync(True)
-        else:
-            return req.commit(0, True)
+        mode_blob = self.mode_blobs.get(mode)
 
-    def atomic_plane_set(self, plane, crtc, source, destination, fb, sync=False):
-        req = pykms.AtomicReq(self.card)
-        req.add(plane, self.__format_props({
-                    'FB_ID': fb.id,
+        ret = -1
+        try:
+            req = pykms.AtomicReq(self.card)
+            req.add(connector, 'CRTC_ID', crtc.id)
+            req.add(crtc, {'ACTIVE': 1, 'MODE_ID': mode_blob.id})
+            if fb:
+                req.add(crtc.primary_plane, {
+                            'FB_ID': fb.id,
+                            'CRTC_ID': crtc.id,
+                            'SRC_X': 0,
+                            'SRC_Y': 0,
+                            'SRC_W': int(fb.width * 65536),
+                            'SRC_H': int(fb.height * 65536),
+                            'CRTC_X': 0,
+                            'CRTC_Y': 0,
+                            'CRTC_W': fb.width,
+                            'CRTC_H': fb.height,
+                })
+            ret = self.__commit(req, sync, True, test_only, crtc)
+            if not test_only and ret == 0:
+                self.__flip_templates.clear()
+            return ret
+        finally:
+            if test_only or ret < 0:
+                self.mode_blobs.put(mode)
+            elif sync:
+                self.__set_active_mode(crtc.id, mode)
+            else:
+                self.__set_pending_mode(crtc.id, mode)
+
+    def __plane_props(self, crtc, source, destination, fb_id):
+        return self.__format_props({
+                    'FB_ID': fb_id,
                     'CRTC_ID': crtc.id,
                     'SRC_X': int(source.left * 65536),
                     'SRC_Y': int(source.top * 65536),
@@ -249,46 +1558,198 @@ class KMSTest(object):
                     'CRTC_Y': destination.top,
                     'CRTC_W': destination.width,
                     'CRTC_H': destination.height,
-        }))
-        if sync:
-            return req.commit_sync()
+        })
+
+    def atomic_plane_set(self, plane, crtc, source, destination, fb, sync=False, test_only=False):
+        req = pykms.AtomicReq(self.card)
+        req.add(plane, self.__plane_props(crtc, source, destination, fb.id))
+        ret = self.__commit(req, sync, test_only=test_only, crtc=crtc)
+        if not test_only and ret == 0:
+            self.__flip_templates.pop(plane.id, None)
+        return ret
+
+    def plane_flip_template(self, plane, crtc, source, destination):
+        """Create a template for page flips on the given plane and CRTC with
+        fixed source and destination rectangles, to be used with
+        atomic_plane_flip()."""
+        return PlaneFlipTemplate(plane, crtc, self.__plane_props(crtc, source, destination, 0))
+
+    def atomic_plane_flip(self, template, fb, sync=False):
+        """Flip the plane described by the template to the framebuffer fb. This
+        is equivalent to atomic_plane_set() with the template parameters. Once
+        the template has been committed, only the framebuffer ID is added to
+        the request, as the atomic state retains the other plane properties
+        until another helper changes them."""
+        plane = template.plane
+
+        req = pykms.AtomicReq(self.card)
+        if self.__flip_templates.get(plane.id) is template:
+            req.add(plane, 'FB_ID', fb.id)
         else:
-            return req.commit(0)
+            props = template.props
+            props['FB_ID'] = fb.id
+            req.add(plane, props)
+
+        ret = self.__commit(req, sync, crtc=template.crtc)
+        if ret == 0:
+            self.__flip_templates[plane.id] = template
+        return ret
 
-    def atomic_planes_disable(self, sync=True):
+    def atomic_planes_disable(self, sync=True, test_only=False):
         req = pykms.AtomicReq(self.card)
         for plane in self.card.planes:
             req.add(plane, {"FB_ID": 0, 'CRTC_ID': 0})
 
-        if sync:
-            return req.commit_sync()
-        else:
-            return req.commit(0)
+        ret = self.__commit(req, sync, test_only=test_only)
+        if not test_only and ret == 0:
+            self.__flip_templates.clear()
+        return ret
+
+    def atomic_test_batch(self, helper, candidates):
+        """Check candidate configurations with test-only commits, without
+        modifying the device state. helper is one of the atomic_*() helpers
+        accepting a test_only argument, and candidates a list of positional
+        argument tuples for the helper. Return a list of booleans telling
+        whether each candidate configuration is accepted by the device."""
+        return [helper(*args, test_only=True) >= 0 for args in candidates]
 
-    def __handle_page_flip(self, frame, time):
+    def __handle_page_flip(self, frame, time, crtc_id=None):
         self.flips += 1
-        try:
-            # The handle_page_flip() method is optional, ignore attribute errors
-            self.handle_page_flip(frame, time)
-        except AttributeError:
-            pass
 
-    def __read_event(self, fileobj, events):
+        # Fall back to the only CRTC handler, if any, when the event doesn't
+        # identify the CRTC.
+        if crtc_id is None and len(self.__crtc_flip_handlers) == 1:
+            handler = next(iter(self.__crtc_flip_handlers.values()))
+        else:
+            handler = self.__crtc_flip_handlers.get(crtc_id)
+
+        if handler:
+            handler(frame, time)
+        else:
+            try:
+                # The handle_page_flip() method is optional, ignore attribute
+                # errors
+                self.handle_page_flip(frame, time)
+            except AttributeError:
+                pass
+
+        # Complete the futures waiting for a page flip on this CRTC.
+        if self.__flip_waiters:
+            waiters = self.__flip_waiters
+            self.__flip_waiters = []
+            for waiter in waiters:
+                waiter_crtc_id, future = waiter
+                if future.done():
+                    continue
+                if waiter_crtc_id is None or crtc_id is None or waiter_crtc_id == crtc_id:
+                    future.set_result((frame, time))
+                else:
+                    self.__flip_waiters.append(waiter)
+
+    def set_flip_handler(self, crtc, handler):
+        """Set the page flip handler for the CRTC. Page flip events for the
+        CRTC are dispatched to the handler instead of handle_page_flip(). A
+        None handler removes the CRTC page flip handler."""
+        if handler:
+            self.__crtc_flip_handlers[crtc.id] = handler
+        else:
+            self.__crtc_flip_handlers.pop(crtc.id, None)
+
+    def __read_event(self, fileobj=None, events=None):
+        now = time.clock_gettime(time.CLOCK_MONOTONIC)
         for event in self.card.read_events():
             if event.type == pykms.DrmEventType.FLIP_COMPLETE:
-                self.__handle_page_flip(event.seq, event.time)
-
-    def __read_logger(self, fileobj, events):
+                # Identify the CRTC from the event if supported by pykms, or
+                # from the user data passed to the commit otherwise.
+                crtc_id = getattr(event, 'crtc_id', 0) or getattr(event, 'data', 0)
+                if crtc_id:
+                    self.commit_latency.complete(crtc_id, now)
+                    self.__complete_mode_set(crtc_id)
+                self.__handle_page_flip(event.seq, event.time, crtc_id or None)
+
+    def __read_logger(self, fileobj=None, events=None):
         self.logger.event()
 
+    def __check_kernel_log(self, msgs):
+        for msg in self.__fault_matcher.scan(msgs):
+            self.kernel_faults.append((self.test_name, msg))
+
+            if self.abort_on_kernel_fault and not self.__kernel_fault:
+                self.__kernel_fault = KernelFault(self.test_name, msg)
+                self.loop.stop()
+                if self.__main_task:
+                    self.__main_task.cancel()
+
+    def __raise_kernel_fault(self):
+        # Faults detected outside of the event loop only stop the next loop
+        # run through this check, as EventLoop.run() clears stop requests.
+        if self.__kernel_fault:
+            fault = self.__kernel_fault
+            self.__kernel_fault = None
+            raise fault
+
     def __read_key(self, fileobj, events):
         sys.stdin.readline()
         self.loop.stop()
 
+    def __run_async(self):
+        self.async_loop = asyncio.new_event_loop()
+        self.async_loop.add_reader(self.logger.fd, self.__read_logger)
+        self.async_loop.add_reader(self.card.fd, self.__read_event)
+        self.flips = 0
+
+        try:
+            self.__main_task = self.async_loop.create_task(self.main())
+            self.async_loop.run_until_complete(self.__main_task)
+        except asyncio.CancelledError:
+            self.__raise_kernel_fault()
+            raise
+        finally:
+            self.__main_task = None
+            self.async_loop.remove_reader(self.card.fd)
+            self.async_loop.remove_reader(self.logger.fd)
+            self.async_loop.close()
+            self.async_loop = None
+            self.__flip_waiters = []
+
     @KernelLogValidator
     def execute(self):
         """Execute the test by running the main function."""
-        self.main()
+        if inspect.iscoroutinefunction(self.main):
+            self.__run_async()
+        else:
+            self.main()
+
+        self.logger.log("Framebuffer pool: %s" % self.fb_pool.stats())
+        self.logger.log("Pattern cache: %s" % self.patterns.stats())
+        self.logger.log("Mode blobs: %s" % self.mode_blobs.stats())
+        for line in self.commit_latency.report():
+            self.logger.log(line)
+
+    def wait_flip(self, crtc=None):
+        """Wait for the next page flip, optionally restricted to the given CRTC.
+        Return an awaitable that completes with the (frame, time) tuple of the
+        page flip. Only available when main() is a coroutine function."""
+        future = self.async_loop.create_future()
+        self.__flip_waiters.append((crtc.id if crtc else None, future))
+        return future
+
+    def wait_capture(self, streamer):
+        """Wait for the next frame captured by the V4L2 capture streamer.
+        Return an awaitable that completes with the dequeued frame buffer. The
+        caller is responsible for queueing the frame buffer back. Only available
+        when main() is a coroutine function."""
+        future = self.async_loop.create_future()
+
+        def frame_ready():
+            if not future.done():
+                future.set_result(streamer.dequeue())
+
+        # Stop monitoring the capture fd when the future completes or is
+        # cancelled (for instance by asyncio.wait_for()).
+        self.async_loop.add_reader(streamer.fd, frame_ready)
+        future.add_done_callback(lambda f: self.async_loop.remove_reader(streamer.fd))
+        return future
 
     def flush_events(self):
         """Discard all pending DRM events."""
@@ -313,15 +1774,79 @@ class KMSTest(object):
     def run(self, duration):
         """Run the event loop for the given duration (in seconds)."""
         self.flips = 0
+        self.__raise_kernel_fault()
         self.loop.run(duration)
+        self.__raise_kernel_fault()
+
+    def wait_until(self, predicate, timeout):
+        """Run the event loop until predicate() returns True or the timeout (in
+        seconds) expires. The predicate is checked after every event. Return
+        the final value of the predicate."""
+        self.__raise_kernel_fault()
+        self.loop.run(timeout, predicate)
+        self.__raise_kernel_fault()
+        return predicate()
+
+    def wait_flips(self, count=1, timeout=1):
+        """Run the event loop until count page flips complete or the timeout (in
+        seconds) expires. Return True if all page flips completed."""
+        self.flips = 0
+        return self.wait_until(lambda: self.flips >= count, timeout)
+
+    def settle(self):
+        """Run the event loop for settle_time seconds to let the monitor
+        display the output. This returns immediately by default."""
+        self.__raise_kernel_fault()
+        if self.settle_time > 0:
+            self.loop.run(self.settle_time)
+            self.__raise_kernel_fault()
+
+    def __record_result(self, status, reason=None):
+        if self.test_start is not None:
+            duration = time.clock_gettime(time.CLOCK_MONOTONIC) - self.test_start
+        else:
+            duration = 0.
+
+        self.results.append({
+            'name': self.test_name,
+            'status': status,
+            'reason': reason,
+            'duration': duration,
+            'commit_latency': self.commit_latency.summary(self.__latency_start),
+        })
 
     def start(self, name):
         """Start a test."""
         self.test_name = name
+        self.test_start = time.clock_gettime(time.CLOCK_MONOTONIC)
+        self.__latency_start = self.commit_latency.counts()
         self.logger.log("Testing %s" % name)
         sys.stdout.write("Testing %s: " % name)
         sys.stdout.flush()
 
+    def fail_test(self, name, reason):
+        """Mark the test name as failed after the fact. The result of a
+        completed test is updated in place, the current test is completed with
+        a failure if it is still running. Faults outside of any test are
+        reported as a separate test named after the test class."""
+        for result in reversed(self.results):
+            if result['name'] != name:
+                continue
+
+            self.logger.log("Test %s failed. Reason: %s" % (name, reason))
+            if result['status'] == 'fail':
+                result['reason'] = "%s; %s" % (result['reason'], reason)
+            else:
+                result['status'] = 'fail'
+                result['reason'] = reason
+                sys.stdout.write("Testing %s: FAIL\n" % name)
+                sys.stdout.flush()
+            return
+
+        if name is None or name != self.test_name:
+            self.start(name or self.__class__.__name__)
+        self.fail(reason)
+
     def progress(self, current, maximum):
         sys.stdout.write("\rTesting %s: %u/%u" % (self.test_name, current, maximum))
         sys.stdout.flush()
@@ -330,6 +1855,7 @@ class KMSTest(object):
         """Complete a test with failure."""
         self.logger.log("Test failed. Reason: %s" % reason)
         self.logger.flush()
+        self.__record_result('fail', reason)
         sys.stdout.write("\rTesting %s: FAIL\n" % self.test_name)
         sys.stdout.flush()
         return self.fail
@@ -338,6 +1864,7 @@ class KMSTest(object):
         """Complete a test with skip."""
         self.logger.log("Test skipped. Reason: %s" % reason)
         self.logger.flush()
+        self.__record_result('skip', reason)
         sys.stdout.write("SKIP\n")
         sys.stdout.flush()
         return self.skip
@@ -346,6 +1873,7 @@ class KMSTest(object):
         """Complete a test with success."""
         self.logger.log("Test completed successfully")
         self.logger.flush()
+        self.__record_result('success')
         sys.stdout.write("\rTesting %s: SUCCESS\n" % self.test_name)
         sys.stdout.flush()
         return self.success
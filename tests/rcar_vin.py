@@ -1,7 +1,12 @@
 #!/usr/bin/python3
 
-import os
+import array
+import collections
+import errno
+import fcntl
 import glob
+import os
+import struct
 
 # model strings are null terminated:
 rcar_gen3_models = [
@@ -30,14 +35,222 @@ rcar_gen3_csi2 = [
 ]
 
 
+# Media controller API definitions from linux/media.h
+def _IOWR(type, nr, size):
+    return (3 << 30) | (size << 16) | (ord(type) << 8) | nr
+
+MEDIA_DEVICE_INFO = struct.Struct('=16s32s40s32sIII31I')
+MEDIA_ENTITY_DESC = struct.Struct('=I32sIIIIHH4I184s')
+MEDIA_LINKS_ENUM = struct.Struct('@IPP4I')
+MEDIA_PAD_DESC = struct.Struct('=IHxxI2I')
+# struct media_link_desc is a source and a sink media_pad_desc followed by the
+# link flags and reserved fields
+MEDIA_LINK_DESC = struct.Struct('=' + MEDIA_PAD_DESC.format[1:] * 2 + 'I2I')
+MEDIA_LINK_FLAGS = struct.Struct('=I')
+
+# Named fields of the descriptors, excluding the reserved fields
+MediaDeviceInfo = collections.namedtuple('MediaDeviceInfo',
+    ['driver', 'model', 'serial', 'bus_info', 'media_version', 'hw_revision',
+     'driver_version'])
+MediaEntityDesc = collections.namedtuple('MediaEntityDesc',
+    ['id', 'name', 'type', 'revision', 'flags', 'group_id', 'pads', 'links'])
+MediaPadDesc = collections.namedtuple('MediaPadDesc', ['entity', 'index', 'flags'])
+MediaLinkDesc = collections.namedtuple('MediaLinkDesc', ['source', 'sink', 'flags'])
+
+MEDIA_IOC_DEVICE_INFO = _IOWR('|', 0x00, MEDIA_DEVICE_INFO.size)
+MEDIA_IOC_ENUM_ENTITIES = _IOWR('|', 0x01, MEDIA_ENTITY_DESC.size)
+MEDIA_IOC_ENUM_LINKS = _IOWR('|', 0x02, MEDIA_LINKS_ENUM.size)
+MEDIA_IOC_SETUP_LINK = _IOWR('|', 0x03, MEDIA_LINK_DESC.size)
+
+MEDIA_ENT_ID_FLAG_NEXT = 1 << 31
+
+MEDIA_LNK_FL_ENABLED = 1 << 0
+MEDIA_LNK_FL_IMMUTABLE = 1 << 1
+
+
+def _cstr(data):
+    return data.split(b'\0', 1)[0].decode()
+
+
+def _unpack_pad_desc(data, offset=0):
+    return MediaPadDesc(*MEDIA_PAD_DESC.unpack_from(data, offset)[:3])
+
+
+def _unpack_link_desc(data, offset=0):
+    return MediaLinkDesc(_unpack_pad_desc(data, offset),
+                         _unpack_pad_desc(data, offset + MEDIA_PAD_DESC.size),
+                         MEDIA_LINK_FLAGS.unpack_from(data, offset + 2 * MEDIA_PAD_DESC.size)[0])
+
+
+class MediaPad(object):
+    def __init__(self, entity, index, flags):
+        self.entity = entity
+        self.index = index
+        self.flags = flags
+
+
+class MediaLink(object):
+    def __init__(self, source, sink, flags):
+        self.source = source
+        self.sink = sink
+        self.flags = flags
+
+    @property
+    def enabled(self):
+        return bool(self.flags & MEDIA_LNK_FL_ENABLED)
+
+    @property
+    def immutable(self):
+        return bool(self.flags & MEDIA_LNK_FL_IMMUTABLE)
+
+    def __str__(self):
+        return "'%s':%u -> '%s':%u" % (self.source.entity.name, self.source.index,
+                                       self.sink.entity.name, self.sink.index)
+
+
+class MediaEntity(object):
+    def __init__(self, id, name, type, flags, pads):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.flags = flags
+        self.pads = [MediaPad(self, i, 0) for i in range(pads)]
+        # Links originating from the entity's source pads
+        self.links = []
+
+
 class MediaController(object):
+    """ Media controller device, accessed through the MEDIA_IOC_* ioctls. The
+        topology is enumerated once when the device is opened and cached. Link
+        state changes made through the MediaController are tracked, to only
+        reset the links that have been changed. """
+
     def __init__(self, device):
-        for f in glob.glob("/dev/media*"):
-            print(f)
-        self.cmd = "/usr/bin/media-ctl -d " + device + " "
+        self.device = device
+        self.fd = os.open(device, os.O_RDWR | os.O_CLOEXEC)
+
+        data = bytearray(MEDIA_DEVICE_INFO.size)
+        fcntl.ioctl(self.fd, MEDIA_IOC_DEVICE_INFO, data)
+        info = MediaDeviceInfo(*MEDIA_DEVICE_INFO.unpack(data)[:7])
+        self.driver = _cstr(info.driver)
+        self.model = _cstr(info.model)
+
+        self.entities = {}
+        self.links = []
+        self.__enumerate()
+
+        # The state of all links is unknown until the first reset
+        self.__changed = set(self.links)
+
+    def __del__(self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+
+    def __enumerate(self):
+        entities = {}
+        id = 0
+
+        while True:
+            data = bytearray(MEDIA_ENTITY_DESC.size)
+            struct.pack_into('=I', data, 0, id | MEDIA_ENT_ID_FLAG_NEXT)
+            try:
+                fcntl.ioctl(self.fd, MEDIA_IOC_ENUM_ENTITIES, data)
+            except OSError as e:
+                if e.errno == errno.EINVAL:
+                    break
+                raise
+
+            desc = MediaEntityDesc(*MEDIA_ENTITY_DESC.unpack(data)[:8])
+            id = desc.id
+            entity = MediaEntity(id, _cstr(desc.name), desc.type, desc.flags, desc.pads)
+            entity.num_links = desc.links
+            entities[id] = entity
+
+        for entity in entities.values():
+            # The kernel fills the pads and links arrays, pass their addresses
+            pads = array.array('B', bytes(MEDIA_PAD_DESC.size * len(entity.pads)))
+            links = array.array('B', bytes(MEDIA_LINK_DESC.size * entity.num_links))
+            data = bytearray(MEDIA_LINKS_ENUM.pack(entity.id, pads.buffer_info()[0],
+                                                   links.buffer_info()[0], 0, 0, 0, 0))
+            fcntl.ioctl(self.fd, MEDIA_IOC_ENUM_LINKS, data)
+
+            for pad in entity.pads:
+                pad.flags = _unpack_pad_desc(pads, MEDIA_PAD_DESC.size * pad.index).flags
+
+            for i in range(entity.num_links):
+                desc = _unpack_link_desc(links, MEDIA_LINK_DESC.size * i)
+                if desc.source.entity not in entities or desc.sink.entity not in entities:
+                    continue
+
+                # Links are reported for both entities, only keep the links
+                # originating from this entity
+                source = entities[desc.source.entity].pads[desc.source.index]
+                if source.entity != entity:
+                    continue
+
+                sink = entities[desc.sink.entity].pads[desc.sink.index]
+                link = MediaLink(source, sink, desc.flags)
+                entity.links.append(link)
+                self.links.append(link)
+
+        self.entities = {entity.name: entity for entity in entities.values()}
+
+    def entity(self, name):
+        try:
+            return self.entities[name]
+        except KeyError:
+            raise ValueError('Entity not found: ' + name)
+
+    def link(self, source, source_pad, sink, sink_pad):
+        """ Return the link between the source and sink entity pads, given by
+            entity name and pad index """
+        for link in self.entity(source).links:
+            if link.source.index == source_pad and link.sink.entity.name == sink and \
+               link.sink.index == sink_pad:
+                return link
+
+        raise ValueError("Link not found: '%s':%u -> '%s':%u" % (source, source_pad, sink, sink_pad))
+
+    def setup_link(self, link, enabled):
+        """ Enable or disable the link, unless it is already in the requested
+            state """
+        if link.enabled == enabled:
+            return
+
+        flags = (link.flags & ~MEDIA_LNK_FL_ENABLED) | (MEDIA_LNK_FL_ENABLED if enabled else 0)
+        data = bytearray(MEDIA_LINK_DESC.pack(link.source.entity.id, link.source.index,
+                                              link.source.flags, 0, 0,
+                                              link.sink.entity.id, link.sink.index,
+                                              link.sink.flags, 0, 0, flags, 0, 0))
+        fcntl.ioctl(self.fd, MEDIA_IOC_SETUP_LINK, data)
+
+        link.flags = flags
+        self.__changed.add(link)
+
+    def setup_route(self, route):
+        """ Enable all links of the route, given as a list of (source, source pad,
+            sink, sink pad) tuples. Other links to the sink pads of the route
+            are disabled first. Links already enabled are left untouched. """
+        links = [self.link(*hop) for hop in route]
+
+        for link in links:
+            for other in self.links:
+                if other.sink == link.sink and other != link and other.enabled and \
+                   not other.immutable:
+                    self.setup_link(other, False)
+
+        for link in links:
+            if not link.immutable:
+                self.setup_link(link, True)
 
     def reset(self):
-        os.system(self.cmd + "-r")
+        """ Disable all mutable links changed since the last reset. The first
+            reset disables all mutable links. """
+        for link in self.__changed:
+            if link.enabled and not link.immutable:
+                self.setup_link(link, False)
+
+        self.__changed = set()
 
 
 class ADV748x(object):
@@ -56,10 +269,20 @@ class RCar_VIN_G3(object):
         if self.model not in rcar_gen3_models:
             raise ValueError('Not a supported R-Car Gen3 platform: ' + self.model)
 
-    # Perhaps we need an interface or python bindings for media controller
+        self.__mc = None
+
     def mc_get_mdev(self):
-        for f in glob.glob("/dev/media*"):
-            print(f)
+        ''' Return the MediaController for the rcar_vin media device '''
+        if self.__mc:
+            return self.__mc
+
+        for device in sorted(glob.glob("/dev/media*")):
+            mc = MediaController(device)
+            if mc.driver == 'rcar_vin':
+                self.__mc = mc
+                return mc
+
+        raise ValueError('rcar_vin media device not found')
 
     def vin_v4l2_device(self, idx):
         ''' Return the V4L2 device path (such as /dev/video23) for a given VIN '''
@@ -73,8 +296,23 @@ class RCar_VIN_G3(object):
     def csi2_name(self, idx):
         return "rcar_csi2 " + rcar_gen3_csi2[idx] + ".csi2"
 
-    def hdmi_in(self):
-        print("Configure for HDMI input")
+    def hdmi_route(self, vin=0, adv748x=None):
+        ''' Return the links from the ADV748x HDMI input through TXA and CSI40 to
+            the given VIN, as (source, source pad, sink, sink pad) tuples '''
+        adv748x = adv748x or ADV748x("4-0070")
+
+        # Pad 0 is the sink and pad 1 the source of the ADV748x HDMI and TXA
+        # entities. Pad 1 is the first virtual channel source of the CSI-2
+        # receiver.
+        return [
+            (adv748x.entity_name('hdmi'), 1, adv748x.entity_name('txa'), 0),
+            (adv748x.entity_name('txa'), 1, self.csi2_name(0), 0),
+            (self.csi2_name(0), 1, self.vin_name(vin), 0),
+        ]
+
+    def hdmi_in(self, vin=0, adv748x=None):
+        ''' Route the ADV748x HDMI input through TXA and CSI40 to the given VIN '''
+        self.mc_get_mdev().setup_route(self.hdmi_route(vin, adv748x))
 
 
 #######################################################################################################################
@@ -82,6 +320,11 @@ class RCar_VIN_G3(object):
 
 def selftest_MediaController():
     mc = MediaController("/dev/media0")
+    print("Media device: " + mc.driver + " (" + mc.model + ")")
+    for entity in mc.entities.values():
+        print("    " + entity.name + ": " + str(len(entity.pads)) + " pads")
+        for link in entity.links:
+            print("        " + str(link) + (" [enabled]" if link.enabled else ""))
     mc.reset()
 
 
@@ -91,7 +334,12 @@ def selftest_RCar_VIN_G3():
     print("Identifying VIN devices:")
     for i in range(8):
         print("    vin" + str(i) + ": " + target.vin_v4l2_device(i))
-    target.mc_get_mdev()
+    mc = target.mc_get_mdev()
+    print("Media device: " + mc.device)
+    print("HDMI input route:")
+    for hop in target.hdmi_route():
+        # Raises a ValueError if the link hasn't been enumerated
+        print("    " + str(mc.link(*hop)))
     target.hdmi_in()
 
 